@@ -0,0 +1,223 @@
+"""Per-user aggregates over the plays table, kept up to date as plays are ingested.
+
+    python aggregates.py rebuild [--user ID] [--db PATH]   recompute from scratch
+    python aggregates.py check [--user ID] [--db PATH]     compare against a recompute, exit 1 on drift
+"""
+import argparse
+import os
+import sqlite3
+import sys
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+
+import columnar
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hour_artist_counts (
+    user_id        TEXT    NOT NULL,
+    hour           INTEGER NOT NULL,  -- 0-23, UTC
+    artist_name    TEXT    NOT NULL,
+    plays          INTEGER NOT NULL,
+    last_played_at INTEGER NOT NULL,
+    PRIMARY KEY (user_id, hour, artist_name)
+);
+
+CREATE TABLE IF NOT EXISTS track_counts (
+    user_id        TEXT    NOT NULL,
+    track_name     TEXT    NOT NULL,
+    artist_name    TEXT    NOT NULL,
+    plays          INTEGER NOT NULL,
+    last_played_at INTEGER NOT NULL,
+    PRIMARY KEY (user_id, track_name, artist_name)
+);
+CREATE INDEX IF NOT EXISTS track_counts_least_played ON track_counts (user_id, plays, last_played_at DESC);
+
+CREATE TABLE IF NOT EXISTS streaks (
+    user_id  TEXT PRIMARY KEY,
+    last_day TEXT    NOT NULL,  -- ISO date of the newest play, UTC
+    current  INTEGER NOT NULL,
+    longest  INTEGER NOT NULL
+);
+"""
+
+TABLES = ["hour_artist_counts", "track_counts", "streaks"]
+
+
+def _utc(played_at):
+    return datetime.fromtimestamp(played_at / 1000, timezone.utc)
+
+
+def create(conn):
+    conn.executescript(SCHEMA)
+
+# -------------------------
+# Incremental maintenance
+# -------------------------
+def apply(conn, user_id, plays):
+    """Fold newly inserted plays [(played_at, track_name, artist_name)] into the aggregates.
+    Runs inside the caller's transaction, so plays and aggregates never disagree."""
+    if not plays:
+        return
+    by_hour = Counter()
+    by_track = Counter()
+    last_played = {}
+    for played_at, track_name, artist_name in plays:
+        hour_key = (_utc(played_at).hour, artist_name)
+        track_key = (track_name, artist_name)
+        by_hour[hour_key] += 1
+        by_track[track_key] += 1
+        last_played[hour_key] = max(last_played.get(hour_key, 0), played_at)
+        last_played[track_key] = max(last_played.get(track_key, 0), played_at)
+
+    conn.executemany(
+        """INSERT INTO hour_artist_counts VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT (user_id, hour, artist_name) DO UPDATE SET
+               plays = plays + excluded.plays,
+               last_played_at = MAX(last_played_at, excluded.last_played_at)""",
+        [(user_id, hour, artist, n, last_played[(hour, artist)]) for (hour, artist), n in by_hour.items()])
+    conn.executemany(
+        """INSERT INTO track_counts VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT (user_id, track_name, artist_name) DO UPDATE SET
+               plays = plays + excluded.plays,
+               last_played_at = MAX(last_played_at, excluded.last_played_at)""",
+        [(user_id, track, artist, n, last_played[(track, artist)]) for (track, artist), n in by_track.items()])
+
+    _advance_streak(conn, user_id, sorted({_utc(p[0]).date() for p in plays}))
+
+
+def _advance_streak(conn, user_id, days):
+    row = conn.execute("SELECT last_day, current, longest FROM streaks WHERE user_id = ?",
+                       (user_id,)).fetchone()
+    last_day, current, longest = (date.fromisoformat(row[0]), row[1], row[2]) if row else (None, 0, 0)
+    if last_day is not None and days[0] < last_day:
+        # Ingestion only moves forward, but if an older play ever slips in the
+        # running state can't absorb it - recount this user's streak instead
+        _rebuild_streak(conn, user_id)
+        return
+    for day in days:
+        if day == last_day:
+            continue
+        current = current + 1 if last_day is not None and day - last_day == timedelta(days=1) else 1
+        longest = max(longest, current)
+        last_day = day
+    conn.execute("INSERT OR REPLACE INTO streaks VALUES (?, ?, ?, ?)",
+                 (user_id, last_day.isoformat(), current, longest))
+
+
+def _rebuild_streak(conn, user_id):
+    conn.execute("DELETE FROM streaks WHERE user_id = ?", (user_id,))
+    days = [date.fromisoformat(r[0]) for r in conn.execute(
+        "SELECT DISTINCT date(played_at / 1000, 'unixepoch') FROM plays WHERE user_id = ? ORDER BY 1",
+        (user_id,))]
+    if days:
+        _advance_streak(conn, user_id, days)
+
+# -------------------------
+# Rebuild + consistency check
+# -------------------------
+def _users(conn, user_id=None):
+    if user_id is not None:
+        return [user_id]
+    return [r[0] for r in conn.execute("SELECT DISTINCT user_id FROM plays")]
+
+
+def _snapshot(conn, user_id):
+    return {table: sorted(conn.execute(f"SELECT * FROM {table} WHERE user_id = ?", (user_id,)).fetchall())
+            for table in TABLES}
+
+
+def rebuild(conn, user_id=None):
+    """Throw the aggregates away and replay every stored play, oldest first"""
+    for user in _users(conn, user_id):
+        with conn:
+            for table in TABLES:
+                conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user,))
+            plays = conn.execute(
+                "SELECT played_at, track_name, artist_name FROM plays WHERE user_id = ? ORDER BY played_at",
+                (user,)).fetchall()
+            apply(conn, user, plays)
+
+
+def recount(conn, user_id=None):
+    """{user: {"hour_artist_counts": rows, "track_counts": rows, "longest": n}} counted
+    straight from the raw plays with the columnar kernels, independently of apply(),
+    for every user in one pass. Rows are sorted like _snapshot's."""
+    query, params = "SELECT user_id, played_at, track_name, artist_name FROM plays", ()
+    if user_id is not None:
+        query, params = query + " WHERE user_id = ?", (user_id,)
+    plays = columnar.PlayColumns.from_rows(conn.execute(query, params).fetchall())
+    counts = {}
+
+    def for_user(user):
+        return counts.setdefault(user, {"hour_artist_counts": [], "track_counts": [], "longest": 0})
+
+    users, tracks, artists = plays.users.values, plays.tracks.values, plays.artists.values
+    # .tolist() first: plain ints compare equal to sqlite's, and iterate much faster than numpy scalars
+    for user, hour, artist, n, last in zip(*(c.tolist() for c in columnar.hour_artist_counts(plays))):
+        for_user(users[user])["hour_artist_counts"].append((users[user], hour, artists[artist], n, last))
+    for user, track, n, last in zip(*(c.tolist() for c in columnar.track_counts(plays))):
+        for_user(users[user])["track_counts"].append((users[user],) + tracks[track] + (n, last))
+    for user, longest in columnar.longest_streaks_by_user(plays).items():
+        for_user(user)["longest"] = longest
+    for user_counts in counts.values():
+        user_counts["hour_artist_counts"].sort()
+        user_counts["track_counts"].sort()
+    return counts
+
+
+def _matches_recount(stored, recounted):
+    if recounted is None:
+        return not any(stored.values())
+    stored_longest = stored["streaks"][0][3] if stored["streaks"] else 0
+    return (stored["hour_artist_counts"] == recounted["hour_artist_counts"]
+            and stored["track_counts"] == recounted["track_counts"]
+            and stored_longest == recounted["longest"])
+
+
+def check(conn, user_id=None):
+    """Users whose stored aggregates differ from a from-scratch recompute (nothing is changed).
+    The recompute is done twice: by replaying apply(), and by the columnar recount."""
+    drifted = []
+    recounted = recount(conn, user_id)
+    for user in _users(conn, user_id):
+        stored = _snapshot(conn, user)
+        if not _matches_recount(stored, recounted.get(user)):
+            drifted.append(user)
+            continue
+        conn.execute("SAVEPOINT aggregates_check")
+        try:
+            for table in TABLES:
+                conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user,))
+            apply(conn, user, conn.execute(
+                "SELECT played_at, track_name, artist_name FROM plays WHERE user_id = ? ORDER BY played_at",
+                (user,)).fetchall())
+            if _snapshot(conn, user) != stored:
+                drifted.append(user)
+        finally:
+            conn.execute("ROLLBACK TO aggregates_check")
+            conn.execute("RELEASE aggregates_check")
+    return drifted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild or check the listening-history aggregates")
+    parser.add_argument("command", choices=["rebuild", "check"])
+    parser.add_argument("--user", help="only this Spotify user id")
+    parser.add_argument("--db", default=os.getenv("HISTORY_DB", "history.db"))
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.db, isolation_level=None if args.command == "check" else "")
+    create(conn)
+    if args.command == "rebuild":
+        rebuild(conn, args.user)
+        print(f"Rebuilt aggregates for {len(_users(conn, args.user))} user(s)")
+        return 0
+    drifted = check(conn, args.user)
+    for user in drifted:
+        print(f"aggregates out of date for {user}")
+    print("OK" if not drifted else f"{len(drifted)} user(s) drifted, run: python aggregates.py rebuild")
+    return 1 if drifted else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,20 @@
 import os
-from datetime import datetime
-from flask import Flask, jsonify, redirect, request
+import json
+import time
+from functools import partial
+from flask import Flask, Response, g, jsonify, redirect, request, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
-import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from spotipy.exceptions import SpotifyException
+from stats import STATS, DASHBOARD_STATS, compute_stats, iter_stats
+from cache import PayloadCache, make_backend, token_key
+from upstream import RateLimited, UpstreamClient
+from history import HistoryStore
+import metrics
+from responses import compress, parse_fields, project
+from jobs import JobQueue
+from tokens import TokenStore
 
 load_dotenv()  # load variables from .env
 
@@ -13,6 +22,40 @@ CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 REDIRECT_URI = os.getenv("REDIRECT_URI")
 
+# Spotify payload cache: "memory" (per process) or "redis" (shared, set REDIS_URL)
+payload_cache = PayloadCache(make_backend(os.getenv("CACHE_BACKEND", "memory"),
+                                          redis_url=os.getenv("REDIS_URL"),
+                                          max_entries=int(os.getenv("CACHE_MAX_ENTRIES", "5000"))))
+
+# Shared Spotify client: keep-alive pool, concurrent fetches, per-user + global rate limits
+upstream = UpstreamClient(pool_size=int(os.getenv("UPSTREAM_POOL_SIZE", "16")),
+                          global_rate=float(os.getenv("UPSTREAM_GLOBAL_RATE", "20")),
+                          user_rate=float(os.getenv("UPSTREAM_USER_RATE", "5")),
+                          api_prefix=os.getenv("SPOTIFY_API_PREFIX"))
+
+# Local listening history (SQLite), grows a little every time recently-played is polled
+history = HistoryStore(os.getenv("HISTORY_DB", "history.db"))
+
+# Tokens the background jobs use. With TOKEN_ENCRYPTION_KEY (a Fernet key) they're stored
+# encrypted in the cache backend, without one they stay in this process.
+token_store = TokenStore(payload_cache.backend, os.getenv("TOKEN_ENCRYPTION_KEY"))
+
+# Background jobs: prewarm a user's dashboard on login, keep recently active users warm.
+# With "redis" any worker process can pick up a job another one enqueued - jobs only
+# carry a user id, so that needs the tokens shared too.
+JOBS_BACKEND = os.getenv("JOBS_BACKEND", os.getenv("CACHE_BACKEND", "memory"))
+jobs = JobQueue(JOBS_BACKEND if token_store.shared else "memory",
+                redis_url=os.getenv("REDIS_URL"),
+                workers=int(os.getenv("JOB_WORKERS", "2")))
+REFRESH_INTERVAL = int(os.getenv("REFRESH_INTERVAL", "300"))
+ACTIVE_USER_WINDOW = int(os.getenv("ACTIVE_USER_WINDOW", str(24 * 60 * 60)))
+
+# JSON bodies at least this big (bytes) are brotli/gzip compressed when the client accepts it
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+
+# Fraction of requests to cProfile (0 = off), results at /metrics/profile
+profiler = metrics.Profiler(float(os.getenv("PROFILE_SAMPLE_RATE", "0")))
+
 app = Flask(__name__)
 app.secret_key = "super_secret_key"  # for sessions
 CORS(app,
@@ -21,11 +64,41 @@ CORS(app,
      methods=["GET", "POST", "OPTIONS"],
      supports_credentials=True)
 
+# Request timing (+ sampled profiling) for /metrics
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.profile = profiler.maybe_start()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    method, started, profile = request.method, g.request_started, g.pop("profile", None)
+
+    # on close, so streamed responses are timed until the last event is sent
+    def finished():
+        if profile is not None:
+            profiler.stop(route, profile)
+        metrics.observe_request(route, method, response.status_code, time.perf_counter() - started)
+
+    response.call_on_close(finished)
+    return response
+
+@app.after_request
+def compress_response(response):
+    return compress(response, request.accept_encodings, COMPRESS_MIN_SIZE)
+
 # Global error handler for Spotify API errors
 @app.errorhandler(SpotifyException)
 def handle_spotify_error(error):
     return jsonify({"error": f"Spotify API error: {str(error)}"}), 401
 
+@app.errorhandler(RateLimited)
+def handle_rate_limited(error):
+    response = jsonify({"error": str(error), "retry_after": error.retry_after})
+    response.headers["Retry-After"] = str(int(error.retry_after + 0.999))
+    return response, 429
+
 @app.errorhandler(Exception)
 def handle_generic_error(error):
     return jsonify({"error": f"Server error: {str(error)}"}), 500
@@ -33,40 +106,72 @@ def handle_generic_error(error):
 # Spotify scope
 scope = "user-top-read user-read-recently-played"
 
-# Helper function to get Spotify object from access token in request
-def get_user_spotify():
+# EventSource can't send headers, so these routes also take the token as ?token=
+QUERY_TOKEN_ENDPOINTS = {"dashboard_stream"}
+
+# Seconds between SSE heartbeats, keeps proxies from closing a quiet stream
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "15"))
+
+# Helper function to get the access token from the request
+def get_access_token():
     # Get token from Authorization header
     auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
+    if auth_header and auth_header.startswith("Bearer "):
+        return auth_header.split(" ")[1]
+    if request.endpoint in QUERY_TOKEN_ENDPOINTS:
+        return request.args.get("token")
+    return None
+
+# Helper function to get Spotify object from access token in request
+def get_user_spotify():
+    access_token = get_access_token()
+    if not access_token:
         return None
-    access_token = auth_header.split(" ")[1]
-    return spotipy.Spotify(auth=access_token)
+    return upstream.spotify(access_token)
+
+# Cache key for a user, so cached payloads survive token refreshes
+def user_id_for(sp, access_token):
+    return payload_cache.user_id(
+        access_token, lambda: upstream.call("token:" + token_key(access_token), "current_user", sp.current_user)["id"])
+
+def get_user_id(sp):
+    user_id = user_id_for(sp, get_access_token())
+    payload_cache.mark_active(user_id)
+    return user_id
+
+def make_oauth():
+    return SpotifyOAuth(client_id=CLIENT_ID,
+                        client_secret=CLIENT_SECRET,
+                        redirect_uri=REDIRECT_URI,
+                        scope=scope,
+                        open_browser=False,
+                        cache_handler=None)
 
 # -------------------------
 # LOGIN / CALLBACK ROUTES
 # -------------------------
 @app.route("/login")
 def login():
-    sp_oauth = SpotifyOAuth(client_id=CLIENT_ID,
-                            client_secret=CLIENT_SECRET,
-                            redirect_uri=REDIRECT_URI,
-                            scope=scope,
-                            open_browser=False,
-                            cache_handler=None)
+    sp_oauth = make_oauth()
     auth_url = sp_oauth.get_authorize_url()
     return redirect(auth_url)
 
 @app.route("/callback")
 def callback():
-    sp_oauth = SpotifyOAuth(client_id=CLIENT_ID,
-                            client_secret=CLIENT_SECRET,
-                            redirect_uri=REDIRECT_URI,
-                            scope=scope,
-                            open_browser=False,
-                            cache_handler=None)
+    sp_oauth = make_oauth()
     code = request.args.get("code")
     token_info = sp_oauth.get_access_token(code, as_dict=True)
     access_token = token_info["access_token"]
+    # Prewarming is only a head start: if any of it fails the first /dashboard computes it, so log and carry on
+    try:
+        user_id = user_id_for(upstream.spotify(access_token), access_token)
+        payload_cache.mark_active(user_id)
+        # Background refreshes may use this login for ACTIVE_USER_WINDOW, refreshing it doesn't extend that
+        token_store.save(user_id, token_info, time.time() + ACTIVE_USER_WINDOW)
+        # Start computing the dashboard now, it should be ready by the time the frontend asks
+        jobs.enqueue("prewarm", user_id)
+    except Exception:
+        app.logger.exception("couldn't schedule the dashboard prewarm after login")
     # Redirect back to the frontend with the token in the URL
     return redirect(f"http://127.0.0.1:3000?token={access_token}")
 
@@ -77,217 +182,220 @@ def callback():
 def home():
     return jsonify({"message": "Hello from Flask backend!"})
 
-@app.route("/top-artists")
-def top_artists():
+@app.route("/metrics")
+def prometheus_metrics():
+    """Prometheus text format: route latency, upstream calls, rate limit hits, cache lookups"""
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+@app.route("/metrics/profile")
+def profile_report():
+    """Merged cProfile stats of the sampled requests, ?route=/dashboard&limit=30&sort=tottime"""
+    report = profiler.report(request.args.get("route"), request.args.get("limit", 30, type=int),
+                             request.args.get("sort", "cumulative"))
+    return Response(report, mimetype="text/plain")
+
+# JSON for stat data: ?fields= projection, plus an ETag over the body so an
+# unchanged stat (same upstream data, same fields) comes back as a bodiless 304
+def stat_json(data):
+    fields = request.args.get("fields")
+    if fields:
+        data = project(data, parse_fields(fields))
+    response = jsonify(data)
+    response.add_etag(weak=True)  # weak: the compressed bytes differ per encoding
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Authorization")
+    return response.make_conditional(request)
+
+def stat_response(name):
     sp = get_user_spotify()
     if not sp:
         return jsonify({"error": "Not authenticated"}), 401
-    results = sp.current_user_top_artists(limit=10, time_range="short_term")
-    artists = [artist['name'] for artist in results['items']]
-    return jsonify({"top_artists_last_4_weeks": artists})
+    return stat_json(compute_stats(sp, [name], payload_cache, get_user_id(sp), upstream, history)[name])
+
+@app.route("/top-artists")
+def top_artists():
+    return stat_response("top_artists")
 
 @app.route("/top-tracks")
 def top_tracks():
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-    results = sp.current_user_top_tracks(limit=10, time_range="short_term")
-    tracks = [{"name": t["name"], "artist": t["artists"][0]["name"]} for t in results["items"]]
-    return jsonify({"top_tracks_last_4_weeks": tracks})
+    return stat_response("top_tracks")
 
 @app.route("/top-artists-medium")
 def top_artists_medium():
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-    results = sp.current_user_top_artists(limit=10, time_range="medium_term")
-    artists = [artist["name"] for artist in results["items"]]
-    return jsonify({"top_artists_last_6_months": artists})
+    return stat_response("top_artists_medium")
 
 @app.route("/top-artists-long")
 def top_artists_long():
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-    results = sp.current_user_top_artists(limit=10, time_range="long_term")
-    artists = [artist["name"] for artist in results["items"]]
-    return jsonify({"top_artists_all_time": artists})
+    return stat_response("top_artists_long")
 
 @app.route("/recently-played")
 def recently_played():
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-    results = sp.current_user_recently_played(limit=20)
-    tracks = [{"name": item["track"]["name"], "artist": item["track"]["artists"][0]["name"]}
-              for item in results["items"]]
-    return jsonify({"recently_played": tracks})
+    return stat_response("recently_played")
 
 @app.route("/hidden-gems")
 def hidden_gems():
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-    results = sp.current_user_top_tracks(limit=50, time_range="medium_term")
-    tracks = [{"name": t["name"], "artist": t["artists"][0]["name"], "popularity": t["popularity"]}
-              for t in results["items"] if t["popularity"] < 50]
-    return jsonify({"hidden_gems": tracks})
+    return stat_response("hidden_gems")
 
 @app.route("/most-skipped")
 def most_skipped():
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-    results = sp.current_user_recently_played(limit=50)
-    tracks = {}
-    for item in results["items"]:
-        key = f"{item['track']['name']} - {item['track']['artists'][0]['name']}"
-        tracks[key] = tracks.get(key, 0) + 1
-    skipped_tracks = sorted(tracks.items(), key=lambda x: x[1])[:10]
-    skipped_list = [{"track": t[0], "approx_plays": t[1]} for t in skipped_tracks]
-    return jsonify({"most_skipped": skipped_list})
+    return stat_response("most_skipped")
 
 @app.route("/top-artist-morning")
 def top_artist_morning():
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-    results = sp.current_user_recently_played(limit=50)
-    morning_tracks = [item for item in results["items"]
-                      if 5 <= datetime.fromisoformat(item["played_at"][:-1]).hour < 11]
-    artists = {}
-    for item in morning_tracks:
-        artist = item["track"]["artists"][0]["name"]
-        artists[artist] = artists.get(artist, 0) + 1
-    top_artist = max(artists, key=artists.get) if artists else None
-    return jsonify({"top_artist_morning": top_artist})
+    return stat_response("top_artist_morning")
 
 @app.route("/top-artist-evening")
 def top_artist_evening():
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-    results = sp.current_user_recently_played(limit=50)
-    evening_tracks = [item for item in results["items"]
-                      if 17 <= datetime.fromisoformat(item["played_at"][:-1]).hour < 23]
-    artists = {}
-    for item in evening_tracks:
-        artist = item["track"]["artists"][0]["name"]
-        artists[artist] = artists.get(artist, 0) + 1
-    top_artist = max(artists, key=artists.get) if artists else None
-    return jsonify({"top_artist_evening": top_artist})
+    return stat_response("top_artist_evening")
 
 @app.route("/recently-played-last-5")
 def recently_played_last_5():
     """Get the last 5 tracks the user listened to"""
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-    
-    results = sp.current_user_recently_played(limit=5)
-    tracks = [
-        {
-            "name": item["track"]["name"],
-            "artist": item["track"]["artists"][0]["name"],
-            "played_at": item["played_at"]
-        }
-        for item in results["items"]
-    ]
-    return jsonify({"recently_played_last_5": tracks})
+    return stat_response("recently_played_last_5")
 
 
 @app.route("/longest-listening-streak")
 def longest_listening_streak():
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-    results = sp.current_user_recently_played(limit=50)
-    if not results["items"]:
-        return jsonify({"longest_streak_days": 0})
-    dates = sorted({datetime.fromisoformat(item["played_at"][:-1]).date() for item in results["items"]})
-    max_streak = current_streak = 1
-    for i in range(1, len(dates)):
-        if (dates[i] - dates[i-1]).days == 1:
-            current_streak += 1
-            max_streak = max(max_streak, current_streak)
-        else:
-            current_streak = 1
-    return jsonify({"longest_streak_days": max_streak})
+    return stat_response("longest_listening_streak")
 
 @app.route("/most-popular-track")
 def most_popular_track():
     """Your most mainstream track - highest popularity score"""
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    results = sp.current_user_top_tracks(limit=50, time_range="medium_term")
-    if not results["items"]:
-        return jsonify({"track": "Not available", "artist": "", "popularity": 0})
-
-    most_popular = max(results["items"], key=lambda t: t["popularity"])
-    return jsonify({
-        "track": most_popular["name"],
-        "artist": most_popular["artists"][0]["name"],
-        "popularity": most_popular["popularity"]
-    })
+    return stat_response("most_popular_track")
 
 @app.route("/least-popular-track")
 def least_popular_track():
     """Your most underground/obscure track - lowest popularity score"""
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    results = sp.current_user_top_tracks(limit=50, time_range="medium_term")
-    if not results["items"]:
-        return jsonify({"track": "Not available", "artist": "", "popularity": 0})
-
-    least_popular = min(results["items"], key=lambda t: t["popularity"])
-    return jsonify({
-        "track": least_popular["name"],
-        "artist": least_popular["artists"][0]["name"],
-        "popularity": least_popular["popularity"]
-    })
+    return stat_response("least_popular_track")
 
 @app.route("/popularity-distribution")
 def popularity_distribution():
     """Distribution of track popularity: underground (<30), moderate (30-60), mainstream (>60)"""
-    sp = get_user_spotify()
-    if not sp:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    results = sp.current_user_top_tracks(limit=50, time_range="medium_term")
-
-    distribution = {"underground": 0, "moderate": 0, "mainstream": 0}
-    for track in results["items"]:
-        pop = track["popularity"]
-        if pop < 30:
-            distribution["underground"] += 1
-        elif pop < 60:
-            distribution["moderate"] += 1
-        else:
-            distribution["mainstream"] += 1
-
-    return jsonify({"popularity_distribution": distribution})
+    return stat_response("popularity_distribution")
 
 @app.route("/avg-popularity")
 def avg_popularity():
     """Average popularity of your top tracks"""
+    return stat_response("avg_popularity")
+
+# ?stats=a,b,c -> (stat names, None) or (None, error response)
+# Without ?stats=, a ?fields= that names stats (fields=avg_popularity,hidden_gems.hidden_gems.name)
+# only computes those
+def selected_stats():
+    selected = request.args.get("stats")
+    fields = [f for f in parse_fields(request.args.get("fields", "")) if f in STATS]
+    if selected:
+        stat_names = [s.strip() for s in selected.split(",") if s.strip()]
+    else:
+        stat_names = fields or DASHBOARD_STATS
+    unknown = [s for s in stat_names if s not in STATS]
+    if unknown:
+        return None, (jsonify({"error": f"Unknown stats: {', '.join(unknown)}"}), 400)
+    return stat_names, None
+
+@app.route("/dashboard")
+def dashboard():
+    """Every dashboard stat in one response - each upstream resource is fetched once.
+    Pick a subset with ?stats=top_artists,avg_popularity"""
+    sp = get_user_spotify()
+    if not sp:
+        return jsonify({"error": "Not authenticated"}), 401
+    stat_names, error = selected_stats()
+    if error:
+        return error
+    user_id = get_user_id(sp)
+    compute = partial(compute_stats, sp, stat_names, payload_cache, user_id, upstream, history)
+    if stat_names == DASHBOARD_STATS:
+        # the default page is cached as a whole (and prewarmed on login)
+        return stat_json(payload_cache.get_or_fetch(user_id, "dashboard", compute))
+    return stat_json(compute())
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route("/dashboard/stream")
+def dashboard_stream():
+    """Server-Sent Events version of /dashboard: one "stat" event per stat as soon as it's
+    computed, then a final "done" (or "error" if any stat failed). Same ?stats= selection."""
     sp = get_user_spotify()
     if not sp:
         return jsonify({"error": "Not authenticated"}), 401
+    stat_names, error = selected_stats()
+    if error:
+        return error
+    user_id = get_user_id(sp)
+    fields = parse_fields(request.args.get("fields", ""))
+    prewarmed = None
+    if stat_names == DASHBOARD_STATS:
+        prewarmed = payload_cache.get(user_id, "dashboard", partial(
+            compute_stats, sp, stat_names, payload_cache, user_id, upstream, history))
+
+    def events():
+        if prewarmed is not None:
+            for name in stat_names:
+                data = project({name: prewarmed[name]}, fields).get(name, {}) if fields else prewarmed[name]
+                yield sse("stat", {"stat": name, "data": data})
+            yield sse("done", {"stats": len(stat_names)})
+            return
+        failed, results = {}, {}
+        for kind, name, value in iter_stats(sp, stat_names, payload_cache, user_id, upstream, history,
+                                            heartbeat=SSE_HEARTBEAT):
+            if kind == "heartbeat":
+                yield ": heartbeat\n\n"
+            elif kind == "stat":
+                results[name] = value
+                # same field paths as /dashboard, i.e. starting with the stat name
+                data = project({name: value}, fields).get(name, {}) if fields else value
+                yield sse("stat", {"stat": name, "data": data})
+            else:
+                failed[name] = str(value)
+        if failed:
+            yield sse("error", {"error": "Some stats could not be computed", "failed": failed})
+        else:
+            if stat_names == DASHBOARD_STATS:
+                payload_cache.put(user_id, "dashboard", results)
+            yield sse("done", {"stats": len(stat_names)})
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-    results = sp.current_user_top_tracks(limit=50, time_range="medium_term")
-    if not results["items"]:
-        return jsonify({"avg_popularity": 0})
 
-    avg = sum(t["popularity"] for t in results["items"]) / len(results["items"])
-    return jsonify({"avg_popularity": round(avg, 1)})
 
 
+# -------------------------
+# BACKGROUND JOBS
+# -------------------------
+def prewarm(user_id):
+    """Compute a user's default dashboard into the shared cache with their stored token
+    (refreshed first if it's about to expire). Not user activity, so nothing is marked."""
+    stored = token_store.load(user_id)
+    if stored is None:
+        return  # logged in too long ago, or through another worker without shared tokens
+    token_info, until = stored
+    if token_info["expires_at"] - time.time() < 60:
+        refreshed = make_oauth().refresh_access_token(token_info["refresh_token"])
+        refreshed.setdefault("refresh_token", token_info["refresh_token"])
+        token_info = refreshed
+        token_store.save(user_id, token_info, until)
+    sp = upstream.spotify(token_info["access_token"])
+    # The stored dashboard is stamped fresh, so it mustn't be built from stale payloads
+    payload_cache.put(user_id, "dashboard", compute_stats(sp, DASHBOARD_STATS, payload_cache, user_id,
+                                                          upstream, history, allow_stale=False))
+
+def refresh_active_users():
+    for user_id in payload_cache.active_users(ACTIVE_USER_WINDOW):
+        jobs.enqueue("prewarm", user_id)
+
+jobs.register("prewarm", prewarm)
+jobs.register("refresh_active_users", refresh_active_users)
+jobs.every(REFRESH_INTERVAL, "refresh_active_users")
+# jobs.start() is left to whatever serves the app (below, or gunicorn.conf.py), so
+# importing it - the reloader's parent process, bench/loadgen.py --spawn - runs no threads
 
 
 # cut off, heres where we run it
 if __name__ == "__main__":
+    # debug=True serves from a reloader child process, that's the one that needs the jobs
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        jobs.start()
     app.run(debug=True, port=8000)
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""Dict-loop recounts vs the columnar kernels, over a whole plays table.
+
+    python bench/bench_columnar.py [--plays 50000] [--users 100] [--tracks 2000] [--repeat 5]
+
+Times what aggregates.check recounts from the raw plays (hour-bucket artist
+counts, per-track counts, longest streaks), the columns built from the rows
+included. Checks both give the same answers, then prints best-of-N timings.
+
+The popularity routes only ever see the 50-track top_tracks_medium payload;
+at that size building columns costs more than the dict loops, so they stay loops.
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import columnar  # noqa: E402
+
+# -------------------------
+# Synthetic plays, as rows of the history store
+# -------------------------
+def make_play_rows(n, users, tracks, seed=0):
+    """(user_id, played_at_ms, track_name, artist_name) rows, like aggregates.check reads"""
+    rng = random.Random(seed)
+    catalog = [(f"Track {i}", f"Artist {rng.randint(0, tracks // 10 or 1)}") for i in range(tracks)]
+    rows = []
+    for u in range(users):
+        played = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        for _ in range(n // users):
+            # mostly a few minutes apart, with the occasional day or more of silence
+            played += (timedelta(minutes=rng.randint(2, 60)) if rng.random() > 0.01
+                       else timedelta(days=rng.randint(1, 3)))
+            rows.append((f"user{u}", int(played.timestamp() * 1000)) + rng.choice(catalog))
+    return rows
+
+# -------------------------
+# The dict-loop versions
+# -------------------------
+def _utc(played_at):
+    return datetime.fromtimestamp(played_at / 1000, timezone.utc)
+
+
+def loop_hour_artist_counts(rows):
+    counts = defaultdict(lambda: [0, -1])
+    for user_id, played_at, _, artist_name in rows:
+        entry = counts[(user_id, _utc(played_at).hour, artist_name)]
+        entry[0] += 1
+        entry[1] = max(entry[1], played_at)
+    return sorted(key + tuple(value) for key, value in counts.items())
+
+
+def loop_track_counts(rows):
+    counts = defaultdict(lambda: [0, -1])
+    for user_id, played_at, track_name, artist_name in rows:
+        entry = counts[(user_id, track_name, artist_name)]
+        entry[0] += 1
+        entry[1] = max(entry[1], played_at)
+    return sorted(key + tuple(value) for key, value in counts.items())
+
+
+def loop_longest_streaks(rows):
+    """The streak loop the route used to run, once per user"""
+    days_by_user = defaultdict(set)
+    for user_id, played_at, _, _ in rows:
+        days_by_user[user_id].add(_utc(played_at).date())
+    longest = {}
+    for user_id, days in days_by_user.items():
+        dates = sorted(days)
+        max_streak = current_streak = 1
+        for i in range(1, len(dates)):
+            if (dates[i] - dates[i-1]).days == 1:
+                current_streak += 1
+                max_streak = max(max_streak, current_streak)
+            else:
+                current_streak = 1
+        longest[user_id] = max_streak
+    return longest
+
+# -------------------------
+# Kernel versions (same outputs, columns built from the rows every time)
+# -------------------------
+def _hour_artist_rows(plays):
+    users, artists = plays.users.values, plays.artists.values
+    return sorted((users[u], h, artists[a], n, last)
+                  for u, h, a, n, last in zip(*(c.tolist() for c in columnar.hour_artist_counts(plays))))
+
+
+def _track_rows(plays):
+    users, tracks = plays.users.values, plays.tracks.values
+    return sorted((users[u],) + tracks[t] + (n, last)
+                  for u, t, n, last in zip(*(c.tolist() for c in columnar.track_counts(plays))))
+
+
+def kernel_hour_artist_counts(rows):
+    return _hour_artist_rows(columnar.PlayColumns.from_rows(rows))
+
+
+def kernel_track_counts(rows):
+    return _track_rows(columnar.PlayColumns.from_rows(rows))
+
+
+def kernel_longest_streaks(rows):
+    return columnar.longest_streaks_by_user(columnar.PlayColumns.from_rows(rows))
+
+
+def loop_recount(rows):
+    return loop_hour_artist_counts(rows), loop_track_counts(rows), loop_longest_streaks(rows)
+
+
+def kernel_recount(rows):
+    # what aggregates.check does: one build shared by all three kernels
+    plays = columnar.PlayColumns.from_rows(rows)
+    return _hour_artist_rows(plays), _track_rows(plays), columnar.longest_streaks_by_user(plays)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--plays", type=int, default=50000)
+    parser.add_argument("--users", type=int, default=100, help="users the plays are spread across")
+    parser.add_argument("--tracks", type=int, default=2000, help="distinct tracks in the catalog")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    rows = make_play_rows(args.plays, args.users, args.tracks)
+    cases = [
+        ("hour-bucket artist counts", loop_hour_artist_counts, kernel_hour_artist_counts),
+        ("track counts", loop_track_counts, kernel_track_counts),
+        ("longest streak", loop_longest_streaks, kernel_longest_streaks),
+        ("all three, one build", loop_recount, kernel_recount),
+    ]
+
+    def best(fn):
+        return min(timeit.repeat(lambda: fn(rows), number=1, repeat=args.repeat)) * 1000
+
+    build = best(columnar.PlayColumns.from_rows)
+    print(f"{len(rows)} plays across {args.users} users, best of {args.repeat}")
+    print(f"building columns: {build:.2f} ms (included in every kernel row, once in the last)\n")
+    print(f"{'recount, all users':<28}{'dict loop ms':>14}{'kernel ms':>12}{'speedup':>10}")
+    for name, loop_fn, kernel_fn in cases:
+        expected, got = loop_fn(rows), kernel_fn(rows)
+        if expected != got:
+            print(f"MISMATCH {name}: dict loop and kernel disagree")
+            return 1
+        loop_ms, kernel_ms = best(loop_fn), best(kernel_fn)
+        print(f"{name:<28}{loop_ms:>14.3f}{kernel_ms:>12.3f}{loop_ms / kernel_ms:>9.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
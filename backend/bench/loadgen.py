@@ -0,0 +1,224 @@
+"""Load-test every stat route and a full dashboard load against the mock Spotify API.
+
+    python bench/loadgen.py --spawn                       start mock + backend, run, save results
+    python bench/loadgen.py --backend http://127.0.0.1:8000 --mock http://127.0.0.1:8900
+    python bench/loadgen.py --compare bench/results/A.json bench/results/B.json
+
+Reports p50/p95/p99 latency, throughput and upstream (mock) calls per request
+for each scenario, and writes them to bench/results/<time>-<commit>.json.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+
+ROUTES = [
+    "/top-artists", "/top-tracks", "/top-artists-medium", "/top-artists-long",
+    "/recently-played", "/recently-played-last-5", "/hidden-gems", "/most-skipped",
+    "/top-artist-morning", "/top-artist-evening", "/longest-listening-streak",
+    "/most-popular-track", "/least-popular-track", "/popularity-distribution", "/avg-popularity",
+]
+# A full page load: the frontend's single stream, and the one-shot JSON equivalent
+PAGES = ["/dashboard", "/dashboard/stream"]
+
+# -------------------------
+# Measuring
+# -------------------------
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(p / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def upstream_calls(mock):
+    return requests.get(f"{mock}/_stats", timeout=5).json().get("total", 0)
+
+
+def run_scenario(backend, mock, path, requests_per_scenario, concurrency, tokens):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+
+    def one(i):
+        token = tokens(path, i)
+        start = time.perf_counter()
+        response = session.get(backend + path, headers={"Authorization": f"Bearer {token}"}, timeout=60)
+        response.content  # the stream counts as done once it's fully read
+        return (time.perf_counter() - start) * 1000, response.status_code
+
+    calls_before = upstream_calls(mock)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests_per_scenario)))
+    elapsed = time.perf_counter() - started
+    calls = upstream_calls(mock) - calls_before
+
+    latencies = sorted(ms for ms, _ in results)
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(results),
+        "statuses": statuses,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "mean_ms": round(sum(latencies) / len(latencies), 2),
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "upstream_calls": calls,
+        "upstream_calls_per_request": round(calls / len(results), 3),
+    }
+
+# -------------------------
+# Spawning the mock + backend
+# -------------------------
+def wait_for(url, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def spawn(args, workdir):
+    mock_cmd = [sys.executable, os.path.join(BENCH_DIR, "mock_spotify.py"), "--port", str(args.mock_port),
+                "--latency", str(args.latency), "--jitter", str(args.jitter), "--rate-429", str(args.rate_429)]
+    if args.fixtures:
+        mock_cmd += ["--fixtures", args.fixtures]
+    env = dict(os.environ,
+               SPOTIFY_API_PREFIX=f"http://127.0.0.1:{args.mock_port}/v1/",
+               HISTORY_DB=os.path.join(workdir, "history.db"))
+    backend_cmd = [sys.executable, "-c",
+                   f"import app; app.app.run(port={args.backend_port}, threaded=True)"]
+    procs = [subprocess.Popen(mock_cmd, cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+             subprocess.Popen(backend_cmd, cwd=BACKEND_DIR, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)]
+    mock, backend = f"http://127.0.0.1:{args.mock_port}", f"http://127.0.0.1:{args.backend_port}"
+    wait_for(mock + "/_stats")
+    wait_for(backend + "/")
+    return procs, backend, mock
+
+# -------------------------
+# Results
+# -------------------------
+def git_commit():
+    try:
+        sha = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=BACKEND_DIR) != 0
+        return sha + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_table(results):
+    print(f"{'scenario':<28}{'p50':>9}{'p95':>9}{'p99':>9}{'rps':>9}{'upstream/req':>14}  statuses")
+    for name, r in results.items():
+        print(f"{name:<28}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}"
+              f"{r['throughput_rps']:>9.1f}{r['upstream_calls_per_request']:>14.2f}  {r['statuses']}")
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['commit']} -> {new['commit']}")
+    print(f"{'scenario':<28}{'p50':>16}{'p95':>16}{'upstream/req':>18}")
+    for name, r in new["results"].items():
+        before = old["results"].get(name)
+        if before is None:
+            continue
+
+        def delta(key):
+            return f"{before[key]:.1f}->{r[key]:.1f}"
+
+        print(f"{name:<28}{delta('p50_ms'):>16}{delta('p95_ms'):>16}{delta('upstream_calls_per_request'):>18}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", default="http://127.0.0.1:8000")
+    parser.add_argument("--mock", default="http://127.0.0.1:8900")
+    parser.add_argument("--spawn", action="store_true", help="start the mock and the backend for this run")
+    parser.add_argument("--backend-port", type=int, default=8100)
+    parser.add_argument("--mock-port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=80, help="mock latency, ms (with --spawn)")
+    parser.add_argument("--jitter", type=float, default=40, help="mock jitter, ms (with --spawn)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="mock 429 fraction (with --spawn)")
+    parser.add_argument("--fixtures", help="recorded fixtures for the mock (with --spawn)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=20, help="distinct tokens per scenario to spread requests across")
+    parser.add_argument("--cold", action="store_true", help="a new user for every request (no cache reuse)")
+    parser.add_argument("--routes", help="comma separated subset of scenarios to run")
+    parser.add_argument("--out", default=os.path.join(BENCH_DIR, "results"))
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="diff two saved result files")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return compare(*args.compare)
+
+    run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+    # Every scenario (and run) gets its own users, so no scenario is served from
+    # caches an earlier one filled and upstream calls per request mean what they say
+    if args.cold:
+        def tokens(path, i):
+            return f"bench-{run_id}-{path}-{i}"
+    else:
+        def tokens(path, i):
+            return f"bench-{run_id}-{path}-user{i % args.users}"
+
+    scenarios = ROUTES + PAGES
+    if args.routes:
+        scenarios = [s.strip() for s in args.routes.split(",")]
+
+    procs = []
+    with tempfile.TemporaryDirectory() as workdir:
+        backend, mock = args.backend, args.mock
+        try:
+            if args.spawn:
+                procs, backend, mock = spawn(args, workdir)
+            results = {}
+            for path in scenarios:
+                results[path] = run_scenario(backend, mock, path, args.requests, args.concurrency, tokens)
+                print(f"  {path}: p95 {results[path]['p95_ms']} ms", file=sys.stderr)
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("compare", "out")},
+        "results": results,
+    }
+    os.makedirs(args.out, exist_ok=True)
+    out_path = os.path.join(args.out, f"{run_id}-{commit}.json")
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=1)
+
+    print_table(results)
+    print(f"\nsaved {out_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
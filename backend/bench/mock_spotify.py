@@ -0,0 +1,179 @@
+"""Local stand-in for the parts of the Spotify Web API the backend uses.
+
+    python bench/mock_spotify.py [--port 8900] [--latency 80] [--jitter 40] [--rate-429 0.0]
+                                 [--fixtures recorded.json | --save-fixtures out.json]
+
+Point the backend at it with SPOTIFY_API_PREFIX=http://127.0.0.1:8900/v1/
+Every bearer token is accepted; each distinct token is its own user with its
+own deterministic generated library (or the recorded fixtures, for everyone).
+GET /_stats returns upstream call counts, POST /_reset clears them.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from flask import Flask, jsonify, request
+
+app = Flask(__name__)
+
+config = {"latency": 0.0, "jitter": 0.0, "rate_429": 0.0, "retry_after": 1}
+recorded = None
+libraries = {}
+calls = Counter()
+calls_lock = threading.Lock()
+
+# -------------------------
+# Fixtures
+# -------------------------
+def generate_library(user_id, tracks=300, artists=60, plays=50):
+    """Top artists/tracks per time_range and recently played, seeded by the user id"""
+    rng = random.Random(zlib.crc32(user_id.encode()))
+    artist_pool = [{"id": f"artist{i}", "name": f"Artist {i}", "popularity": rng.randint(0, 100),
+                    "genres": [], "type": "artist"} for i in range(artists)]
+    track_pool = []
+    for i in range(tracks):
+        artist = rng.choice(artist_pool)
+        track_pool.append({"id": f"track{i}", "name": f"Track {i}", "popularity": rng.randint(0, 100),
+                           "duration_ms": rng.randint(120000, 300000), "type": "track",
+                           "artists": [{"id": artist["id"], "name": artist["name"]}]})
+    library = {"top_artists": {}, "top_tracks": {}}
+    for time_range in ("short_term", "medium_term", "long_term"):
+        library["top_artists"][time_range] = rng.sample(artist_pool, min(50, artists))
+        library["top_tracks"][time_range] = rng.sample(track_pool, min(50, tracks))
+
+    played_at = datetime.now(timezone.utc)
+    recent = []
+    for _ in range(plays):
+        played_at -= timedelta(minutes=rng.randint(3, 600))
+        recent.append({"played_at": played_at.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+                       "track": rng.choice(track_pool), "context": None})
+    library["recently_played"] = recent
+    return library
+
+
+def library_for(user_id):
+    if recorded is not None:
+        return recorded
+    if user_id not in libraries:
+        libraries[user_id] = generate_library(user_id)
+    return libraries[user_id]
+
+# -------------------------
+# Request handling
+# -------------------------
+def user_id_from_token():
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer "):
+        return None
+    return "user-" + format(zlib.crc32(auth[7:].encode()), "08x")
+
+
+@app.before_request
+def simulate_upstream():
+    if request.path.startswith("/_"):
+        return None
+    with calls_lock:
+        calls[request.path] += 1
+        calls["total"] += 1
+    delay = config["latency"] + random.uniform(-config["jitter"], config["jitter"])
+    if delay > 0:
+        time.sleep(delay)
+    if user_id_from_token() is None:
+        return jsonify({"error": {"status": 401, "message": "No token provided"}}), 401
+    if config["rate_429"] and random.random() < config["rate_429"]:
+        with calls_lock:
+            calls["429"] += 1
+        response = jsonify({"error": {"status": 429, "message": "API rate limit exceeded"}})
+        response.headers["Retry-After"] = str(config["retry_after"])
+        return response, 429
+    return None
+
+
+def paged(items, limit, offset, href):
+    return {"href": href, "items": items[offset:offset + limit], "limit": limit, "offset": offset,
+            "total": len(items), "next": None, "previous": None}
+
+
+@app.route("/v1/me/")
+@app.route("/v1/me")
+def me():
+    user_id = user_id_from_token()
+    return jsonify({"id": user_id, "display_name": user_id, "type": "user"})
+
+
+@app.route("/v1/me/top/<kind>")
+def top(kind):
+    if kind not in ("artists", "tracks"):
+        return jsonify({"error": {"status": 404, "message": "Not found"}}), 404
+    time_range = request.args.get("time_range", "medium_term")
+    limit = int(request.args.get("limit", 20))
+    offset = int(request.args.get("offset", 0))
+    items = library_for(user_id_from_token())[f"top_{kind}"][time_range]
+    return jsonify(paged(items, limit, offset, request.url))
+
+
+@app.route("/v1/me/player/recently-played")
+def recently_played():
+    limit = int(request.args.get("limit", 20))
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
+    items = library_for(user_id_from_token())["recently_played"]
+
+    def ms(item):
+        return int(datetime.fromisoformat(item["played_at"].replace("Z", "+00:00")).timestamp() * 1000)
+
+    if after is not None:
+        items = [i for i in items if ms(i) > after]
+    if before is not None:
+        items = [i for i in items if ms(i) < before]
+    items = items[:limit]
+    cursors = {"after": str(ms(items[0])), "before": str(ms(items[-1]))} if items else None
+    return jsonify({"href": request.url, "items": items, "limit": limit, "next": None, "cursors": cursors})
+
+
+@app.route("/_stats")
+def stats():
+    with calls_lock:
+        return jsonify(dict(calls))
+
+
+@app.route("/_reset", methods=["POST"])
+def reset():
+    with calls_lock:
+        calls.clear()
+    return jsonify({"ok": True})
+
+
+def main(argv=None):
+    global recorded
+    parser = argparse.ArgumentParser(description="Mock Spotify Web API for offline benchmarks")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=80, help="mean added latency per call, ms")
+    parser.add_argument("--jitter", type=float, default=40, help="+/- uniform jitter, ms")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--fixtures", help="serve this recorded fixture file instead of generated data")
+    parser.add_argument("--save-fixtures", help="write a generated fixture file here and exit")
+    args = parser.parse_args(argv)
+
+    if args.save_fixtures:
+        with open(args.save_fixtures, "w") as f:
+            json.dump(generate_library("fixture-user"), f, indent=1)
+        return 0
+    if args.fixtures:
+        with open(args.fixtures) as f:
+            recorded = json.load(f)
+
+    config.update(latency=args.latency / 1000, jitter=args.jitter / 1000,
+                  rate_429=args.rate_429, retry_after=args.retry_after)
+    app.run(port=args.port, threaded=True)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # only needed for the shared backend
+    redis = None
+
+import metrics
+
+# resource -> (fresh for, then served stale for) in seconds
+# Recently played moves constantly; top items per time_range barely change within a day.
+RESOURCE_TTLS = {
+    "recently_played": (60, 10 * 60),
+    "top_artists_short": (60 * 60, 6 * 60 * 60),
+    "top_tracks_short": (60 * 60, 6 * 60 * 60),
+    "top_artists_medium": (6 * 60 * 60, 24 * 60 * 60),
+    "top_tracks_medium": (6 * 60 * 60, 24 * 60 * 60),
+    "top_artists_long": (24 * 60 * 60, 3 * 24 * 60 * 60),
+    # the computed default dashboard, shared across workers and prewarmed on login
+    "dashboard": (60, 10 * 60),
+}
+DEFAULT_TTL = (5 * 60, 30 * 60)
+
+# Access tokens live for an hour, so the token -> user id mapping never needs to outlive that
+USER_ID_TTL = 60 * 60
+
+def token_key(access_token):
+    """Stable, non-reversible stand-in for an access token"""
+    return hashlib.sha256(access_token.encode()).hexdigest()
+
+# -------------------------
+# Backends (get/set of JSON-able entries with an expiry)
+# -------------------------
+class MemoryBackend:
+    """In-process LRU, bounded to max_entries"""
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._scored = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expire_seconds):
+        with self._lock:
+            self._entries[key] = (time.time() + expire_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def add_scored(self, key, member, score):
+        with self._lock:
+            self._scored.setdefault(key, {})[member] = score
+
+    def members_since(self, key, min_score):
+        with self._lock:
+            members = self._scored.get(key, {})
+            for member in [m for m, score in members.items() if score < min_score]:
+                del members[member]
+            return list(members)
+
+
+class RedisBackend:
+    """Shared across processes/hosts. Bound memory on the server with
+    maxmemory + maxmemory-policy allkeys-lru."""
+
+    def __init__(self, url, prefix="datify:"):
+        if redis is None:
+            raise RuntimeError("redis is not installed, pip install redis or use the memory cache backend")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, expire_seconds):
+        self.client.setex(self.prefix + key, int(expire_seconds), json.dumps(value))
+
+    def add_scored(self, key, member, score):
+        self.client.zadd(self.prefix + key, {member: score})
+
+    def members_since(self, key, min_score):
+        self.client.zremrangebyscore(self.prefix + key, "-inf", f"({min_score}")
+        return [m.decode() for m in self.client.zrangebyscore(self.prefix + key, min_score, "+inf")]
+
+
+def make_backend(kind="memory", redis_url=None, max_entries=5000):
+    if kind == "redis":
+        return RedisBackend(redis_url or "redis://localhost:6379/0")
+    return MemoryBackend(max_entries=max_entries)
+
+# -------------------------
+# Payload cache
+# -------------------------
+class PayloadCache:
+    """Spotify payloads keyed by user id + resource (resource names already pin the
+    endpoint and its params). Stale entries are returned straight away while a
+    background thread refreshes them."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def user_id(self, access_token, fetch_user_id):
+        # Never key on (or store) the raw token, only a hash of it
+        key = "token:" + token_key(access_token)
+        user_id = self.backend.get(key)
+        if user_id is None:
+            user_id = fetch_user_id()
+            self.backend.set(key, user_id, USER_ID_TTL)
+        return user_id
+
+    def get(self, user_id, resource, refresh, allow_stale=True):
+        """Cached value (stale ones kick off refresh() in the background), or None.
+        With allow_stale=False a stale entry counts as a miss."""
+        key = f"payload:{user_id}:{resource}"
+        fresh_for, stale_for = RESOURCE_TTLS.get(resource, DEFAULT_TTL)
+        entry = self.backend.get(key)
+        if entry is None:
+            metrics.CACHE_LOOKUPS.labels(resource, "miss").inc()
+            return None
+        if time.time() - entry["fetched_at"] >= fresh_for:
+            metrics.CACHE_LOOKUPS.labels(resource, "stale").inc()
+            if not allow_stale:
+                return None
+            self._refresh_in_background(key, refresh, fresh_for + stale_for)
+        else:
+            metrics.CACHE_LOOKUPS.labels(resource, "hit").inc()
+        return entry["value"]
+
+    def get_or_fetch(self, user_id, resource, fetch, allow_stale=True):
+        value = self.get(user_id, resource, fetch, allow_stale)
+        return value if value is not None else self.put(user_id, resource, fetch())
+
+    def put(self, user_id, resource, value):
+        fresh_for, stale_for = RESOURCE_TTLS.get(resource, DEFAULT_TTL)
+        return self._store(f"payload:{user_id}:{resource}", value, fresh_for + stale_for)
+
+    # -------------------------
+    # Who's been around lately (for background refreshes)
+    # -------------------------
+    def mark_active(self, user_id):
+        self.backend.add_scored("active_users", user_id, time.time())
+
+    def active_users(self, within_seconds):
+        return self.backend.members_since("active_users", time.time() - within_seconds)
+
+    def _store(self, key, value, expire_seconds):
+        self.backend.set(key, {"value": value, "fetched_at": time.time()}, expire_seconds)
+        return value
+
+    def _refresh_in_background(self, key, fetch, expire_seconds):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._store(key, fetch(), expire_seconds)
+            except Exception:
+                pass  # keep serving the stale copy, the next read will try again
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
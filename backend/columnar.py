@@ -0,0 +1,108 @@
+import numpy as np
+
+MS_PER_HOUR = 60 * 60 * 1000
+MS_PER_DAY = 24 * MS_PER_HOUR
+
+# -------------------------
+# Interning: strings -> dense int ids
+# -------------------------
+class Interner:
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def intern(self, value):
+        idx = self.ids.get(value)
+        if idx is None:
+            idx = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return idx
+
+    def intern_all(self, values):
+        return np.fromiter((self.intern(v) for v in values), dtype=np.int32)
+
+    def __getitem__(self, idx):
+        return self.values[idx]
+
+# -------------------------
+# Columns
+# -------------------------
+class PlayColumns:
+    """Plays as parallel arrays: user, track and artist are interned ids,
+    played_at is ms since epoch (UTC), hour/day are derived from it once."""
+
+    def __init__(self, user, played_at, track, artist, users, tracks, artists):
+        self.user = user
+        self.played_at = played_at
+        self.hour = ((played_at // MS_PER_HOUR) % 24).astype(np.int8)
+        self.day = (played_at // MS_PER_DAY).astype(np.int32)
+        self.track = track
+        self.artist = artist
+        self.users = users
+        self.tracks = tracks
+        self.artists = artists
+
+    @classmethod
+    def from_rows(cls, rows, users=None, tracks=None, artists=None):
+        """From (user_id, played_at_ms, track_name, artist_name) rows, e.g. the history store's plays table"""
+        users, tracks, artists = users or Interner(), tracks or Interner(), artists or Interner()
+        user = users.intern_all(r[0] for r in rows)
+        played_at = np.fromiter((r[1] for r in rows), dtype=np.int64, count=len(rows))
+        track = tracks.intern_all((r[2], r[3]) for r in rows)
+        artist = artists.intern_all(r[3] for r in rows)
+        return cls(user, played_at, track, artist, users, tracks, artists)
+
+    def __len__(self):
+        return len(self.played_at)
+
+# -------------------------
+# Kernels
+# -------------------------
+def counts_by(plays, columns, sizes):
+    """Plays and newest played_at per distinct combination of id columns (each column's
+    ids in range(size)). Returns ([ids per column], counts, last_played_at), sorted."""
+    key = np.zeros(len(plays), dtype=np.int64)
+    for column, size in zip(columns, sizes):
+        key = key * size + column
+    keys, inverse = np.unique(key, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(keys))
+    last_played = np.full(len(keys), -1, dtype=np.int64)
+    np.maximum.at(last_played, inverse, plays.played_at)
+    ids = []
+    for size in reversed(sizes):
+        ids.append(keys % size)
+        keys = keys // size
+    return ids[::-1], counts, last_played
+
+
+def hour_artist_counts(plays):
+    """Hour-bucket plays per (user, hour UTC, artist): what the top-artist-by-time-of-day
+    stats read. Returns (user, hour, artist, plays, last_played_at) columns."""
+    (user, hour, artist), counts, last_played = counts_by(
+        plays, (plays.user, plays.hour, plays.artist), (max(len(plays.users.values), 1), 24,
+                                                        max(len(plays.artists.values), 1)))
+    return user, hour, artist, counts, last_played
+
+
+def track_counts(plays):
+    """Plays per (user, track). Returns (user, track, plays, last_played_at) columns."""
+    (user, track), counts, last_played = counts_by(
+        plays, (plays.user, plays.track), (max(len(plays.users.values), 1), max(len(plays.tracks.values), 1)))
+    return user, track, counts, last_played
+
+
+def longest_streaks_by_user(plays):
+    """{user id: longest streak} for a whole cohort in one pass"""
+    if not len(plays):
+        return {}
+    # distinct (user, day) pairs, sorted, packed into one int64 so np.unique stays 1-D
+    pairs = np.unique((plays.user.astype(np.int64) << 32) | plays.day.astype(np.int64))
+    user, day = pairs >> 32, pairs & 0xFFFFFFFF
+    # a run continues while the user stays the same and the day advances by exactly one
+    continues = (np.diff(user) == 0) & (np.diff(day) == 1)
+    run_id = np.concatenate(([0], np.cumsum(~continues)))
+    run_length = np.bincount(run_id)
+    run_user = user[np.concatenate(([0], np.flatnonzero(~continues) + 1))]
+    longest = np.zeros(len(plays.users.values), dtype=np.int64)
+    np.maximum.at(longest, run_user, run_length)
+    return {plays.users[i]: int(n) for i, n in enumerate(longest) if n}
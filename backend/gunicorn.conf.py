@@ -0,0 +1,45 @@
+"""Production serving: gunicorn -c gunicorn.conf.py wsgi:app  (from backend/)
+
+Run with CACHE_BACKEND=redis so every worker shares the payload cache, user ids
+and prewarmed dashboards, and with TOKEN_ENCRYPTION_KEY (a Fernet key, from
+cryptography.fernet.Fernet.generate_key()) to share the background job queue
+and the tokens its jobs use. The SQLite play history
+(HISTORY_DB) is shared through WAL, so keep all workers on one host. The
+upstream rate limits are per worker: divide UPSTREAM_GLOBAL_RATE accordingly.
+"""
+import logging
+import multiprocessing
+import os
+import tempfile
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# threads, so a worker holding a few long lived /dashboard/stream connections still serves other requests
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = 120
+# each worker imports the app itself, so its pools, sqlite connections and job threads are its own
+preload_app = False
+
+# per-worker metric files, merged by /metrics (see metrics.render)
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="datify-metrics-"))
+
+
+def on_starting(server):
+    log = logging.getLogger("gunicorn.error")
+    if os.getenv("CACHE_BACKEND", "memory") != "redis":
+        log.warning("CACHE_BACKEND is not redis: each of the %d workers gets its own cache and job queue", workers)
+    elif not os.getenv("TOKEN_ENCRYPTION_KEY"):
+        log.warning("TOKEN_ENCRYPTION_KEY is not set: tokens and background jobs stay in the worker "
+                    "that handled each login")
+
+
+def post_worker_init(worker):
+    # the worker has just imported the app; start its background job threads
+    from app import jobs
+    jobs.start()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
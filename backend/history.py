@@ -0,0 +1,147 @@
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import aggregates
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plays (
+    user_id     TEXT    NOT NULL,
+    played_at   INTEGER NOT NULL,  -- ms since epoch, UTC
+    track_id    TEXT,
+    track_name  TEXT    NOT NULL,
+    artist_id   TEXT,
+    artist_name TEXT    NOT NULL,
+    PRIMARY KEY (user_id, played_at)
+);
+CREATE INDEX IF NOT EXISTS plays_played_at ON plays (played_at);
+CREATE INDEX IF NOT EXISTS plays_user_artist ON plays (user_id, artist_name);
+
+CREATE TABLE IF NOT EXISTS ingest_state (
+    user_id        TEXT PRIMARY KEY,
+    last_polled_at REAL NOT NULL
+);
+"""
+
+# Spotify only ever exposes the last 50 plays, this just guards against a runaway cursor
+MAX_PAGES = 20
+PAGE_SIZE = 50
+
+
+def played_at_ms(played_at):
+    """Spotify's "2024-01-31T18:04:05.123Z" -> ms since epoch"""
+    return int(datetime.fromisoformat(played_at.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+class HistoryStore:
+    """Every play we've ever seen per user, appended incrementally from recently-played.
+
+    (user_id, played_at) is the primary key, so re-ingesting the same page is a no-op."""
+
+    def __init__(self, path="history.db"):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            aggregates.create(conn)
+
+    def _connect(self):
+        # One connection per thread; WAL lets readers carry on while another worker writes
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # -------------------------
+    # Ingestion
+    # -------------------------
+    def ingest_items(self, user_id, items):
+        """Append recently-played items and fold the new ones into the aggregates,
+        returns how many were new"""
+        rows = [(user_id, played_at_ms(item["played_at"]),
+                 item["track"].get("id"), item["track"]["name"],
+                 item["track"]["artists"][0].get("id"), item["track"]["artists"][0]["name"])
+                for item in items]
+        with self._connect() as conn:
+            new_plays = [(row[1], row[3], row[5]) for row in rows
+                         if conn.execute("INSERT OR IGNORE INTO plays VALUES (?, ?, ?, ?, ?, ?)", row).rowcount]
+            aggregates.apply(conn, user_id, new_plays)
+            return len(new_plays)
+
+    def cursor(self, user_id):
+        """played_at (ms) of the newest stored play, or None before the first ingest"""
+        row = self._connect().execute("SELECT MAX(played_at) FROM plays WHERE user_id = ?",
+                                      (user_id,)).fetchone()
+        return row[0]
+
+    def sync(self, user_id, fetch_page, latest=None, min_interval=60):
+        """Store what's new in recently-played, polling from our newest play onwards if needed.
+
+        latest is an already fetched recently-played page (newest 50 plays). It is
+        ingested as is, and fetch_page(after) is only called when it doesn't reach
+        back to the newest play we had; without latest, fetch_page(None) fetches
+        the first page. Polls at most once per min_interval seconds per user."""
+        conn = self._connect()
+        row = conn.execute("SELECT last_polled_at FROM ingest_state WHERE user_id = ?",
+                           (user_id,)).fetchone()
+        if row and time.time() - row[0] < min_interval:
+            return 0
+
+        after = self.cursor(user_id)
+        new = 0
+        if latest is not None:
+            items = latest["items"]
+            new = self.ingest_items(user_id, items)
+            reaches_back = (after is None or len(items) < PAGE_SIZE
+                            or played_at_ms(items[-1]["played_at"]) <= after)
+            pages = 0 if reaches_back else MAX_PAGES
+        else:
+            pages = MAX_PAGES
+        for _ in range(pages):
+            page = fetch_page(after)
+            added = self.ingest_items(user_id, page["items"])
+            new += added
+            # Without a cursor the page already holds the newest plays, nothing comes after them
+            if after is None or not added or len(page["items"]) < PAGE_SIZE:
+                break
+            next_after = (page.get("cursors") or {}).get("after")
+            after = int(next_after) if next_after else self.cursor(user_id)
+
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO ingest_state VALUES (?, ?)", (user_id, time.time()))
+        return new
+
+    # -------------------------
+    # Queries (all read the aggregates, never the raw plays)
+    # -------------------------
+    def streak(self, user_id):
+        """(current, longest) run of consecutive (UTC) days with plays"""
+        row = self._connect().execute("SELECT last_day, current, longest FROM streaks WHERE user_id = ?",
+                                      (user_id,)).fetchone()
+        if not row:
+            return 0, 0
+        # The stored run ends on the last day played; it's only still going if that was today or yesterday
+        today = datetime.now(timezone.utc).date()
+        current = row[1] if today - date.fromisoformat(row[0]) <= timedelta(days=1) else 0
+        return current, row[2]
+
+    def least_played_tracks(self, user_id, limit=10):
+        """[("Track - Artist", plays)], fewest plays first, most recently played first on ties"""
+        return self._connect().execute(
+            """SELECT track_name || ' - ' || artist_name, plays FROM track_counts
+               WHERE user_id = ? ORDER BY plays ASC, last_played_at DESC LIMIT ?""",
+            (user_id, limit)).fetchall()
+
+    def top_artist_between(self, user_id, start_hour, end_hour):
+        """Most played artist in hours [start_hour, end_hour) UTC, most recent wins ties.
+        Windows may wrap past midnight, e.g. (22, 2)."""
+        hours = "hour >= ? AND hour < ?" if start_hour <= end_hour else "(hour >= ? OR hour < ?)"
+        row = self._connect().execute(
+            f"""SELECT artist_name FROM hour_artist_counts WHERE user_id = ? AND {hours}
+                GROUP BY artist_name ORDER BY SUM(plays) DESC, MAX(last_played_at) DESC LIMIT 1""",
+            (user_id, start_hour, end_hour)).fetchone()
+        return row[0] if row else None
@@ -0,0 +1,91 @@
+import json
+import logging
+import queue
+import threading
+import time
+
+try:
+    import redis
+except ImportError:  # only needed for the shared queue
+    redis = None
+
+log = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """Background jobs run by a few daemon threads in every worker process.
+
+    With Redis the queue is one shared list, so a job enqueued by one worker
+    (e.g. the one that handled /callback) can be picked up by any of them, and
+    periodic jobs are scheduled once per interval across all processes.
+    Without it everything stays in this process."""
+
+    def __init__(self, kind="memory", redis_url=None, workers=2, prefix="datify:jobs"):
+        self.handlers = {}
+        self.workers = workers
+        self.prefix = prefix
+        self._periodic = []
+        self._started = False
+        if kind == "redis":
+            if redis is None:
+                raise RuntimeError("redis is not installed, pip install redis or use the memory job queue")
+            self.client = redis.Redis.from_url(redis_url or "redis://localhost:6379/0")
+            self._local = None
+        else:
+            self.client = None
+            self._local = queue.Queue()
+
+    def register(self, name, fn):
+        self.handlers[name] = fn
+
+    def enqueue(self, name, *args):
+        job = json.dumps({"name": name, "args": args})
+        if self.client is not None:
+            self.client.rpush(self.prefix, job)
+        else:
+            self._local.put(job)
+
+    def every(self, seconds, name):
+        """Enqueue job `name` every `seconds` (once across all processes when shared)"""
+        self._periodic.append((seconds, name))
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"jobs-{i}", daemon=True).start()
+        for seconds, name in self._periodic:
+            threading.Thread(target=self._schedule, args=(seconds, name), name=f"jobs-every-{name}",
+                             daemon=True).start()
+
+    def _next_job(self):
+        if self.client is not None:
+            item = self.client.blpop(self.prefix, timeout=5)
+            return item[1] if item else None
+        try:
+            return self._local.get(timeout=5)
+        except queue.Empty:
+            return None
+
+    def _work(self):
+        while True:
+            try:
+                raw = self._next_job()
+                if raw is None:
+                    continue
+                job = json.loads(raw)
+                self.handlers[job["name"]](*job["args"])
+            except Exception:
+                log.exception("background job failed")
+                time.sleep(1)  # don't spin if redis itself is down
+
+    def _schedule(self, seconds, name):
+        while True:
+            time.sleep(seconds)
+            try:
+                # whichever process grabs the tick schedules it, the rest skip this round
+                if self.client is None or self.client.set(f"{self.prefix}:tick:{name}", 1, nx=True, ex=int(seconds)):
+                    self.enqueue(name)
+            except Exception:
+                log.exception("scheduling %s failed", name)
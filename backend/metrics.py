@@ -0,0 +1,101 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+REGISTRY = CollectorRegistry()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_LATENCY = Histogram(
+    "datify_request_seconds", "Flask request latency, until the response (or stream) is closed",
+    ["route", "method", "status"], buckets=LATENCY_BUCKETS, registry=REGISTRY)
+UPSTREAM_LATENCY = Histogram(
+    "datify_upstream_request_seconds", "Spotify Web API call latency",
+    ["endpoint", "status"], buckets=LATENCY_BUCKETS, registry=REGISTRY)
+RATE_LIMIT_HITS = Counter(
+    "datify_rate_limit_hits_total", "Spotify 429s (source=spotify) and calls our own limiter refused (source=local)",
+    ["source"], registry=REGISTRY)
+CACHE_LOOKUPS = Counter(
+    "datify_cache_lookups_total", "Payload cache lookups by result (hit, stale, miss)",
+    ["resource", "result"], registry=REGISTRY)
+PROFILED_REQUESTS = Counter(
+    "datify_profiled_requests_total", "Requests sampled for profiling", ["route"], registry=REGISTRY)
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+
+def render():
+    # Under gunicorn each worker writes its samples to PROMETHEUS_MULTIPROC_DIR, so sum them up
+    # there instead of reporting whichever worker happened to answer the scrape
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def upstream_endpoint(url, prefix):
+    """Label for a Spotify URL: its path without the API prefix or query, e.g. "me/top/tracks" """
+    path = url.split("?", 1)[0]
+    if prefix and path.startswith(prefix):
+        path = path[len(prefix):]
+    return path.strip("/") or "/"
+
+
+def observe_request(route, method, status, seconds):
+    REQUEST_LATENCY.labels(route, method, str(status)).observe(seconds)
+
+
+def observe_upstream(endpoint, status, seconds):
+    UPSTREAM_LATENCY.labels(endpoint, str(status)).observe(seconds)
+
+# -------------------------
+# Sampled profiling
+# -------------------------
+class Profiler:
+    """cProfile a random sample_rate fraction of requests and keep merged stats per route.
+
+    Only the request's own thread is profiled, so time spent in the upstream pool
+    shows up as waiting on futures rather than as the calls themselves."""
+
+    def __init__(self, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def maybe_start(self):
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # another profiler is already running on this interpreter
+            return None
+        return profile
+
+    def stop(self, route, profile):
+        profile.disable()
+        PROFILED_REQUESTS.labels(route).inc()
+        with self._lock:
+            if route in self._stats:
+                self._stats[route].add(profile)
+            else:
+                self._stats[route] = pstats.Stats(profile)
+
+    def report(self, route=None, limit=30, sort="cumulative"):
+        out = io.StringIO()
+        with self._lock:
+            routes = [route] if route else sorted(self._stats)
+            for name in routes:
+                if name not in self._stats:
+                    continue
+                out.write(f"==== {name} ====\n")
+                self._stats[name].stream = out
+                self._stats[name].sort_stats(sort).print_stats(limit)
+        return out.getvalue() or "No profiles sampled yet (set PROFILE_SAMPLE_RATE)\n"
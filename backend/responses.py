@@ -0,0 +1,57 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+# -------------------------
+# ?fields= projection
+# -------------------------
+def parse_fields(fields):
+    """Turns "a,b.c,b.d" into {"a": {}, "b": {"c": {}, "d": {}}}, an empty dict keeps everything below"""
+    tree = {}
+    for path in fields.split(","):
+        parts = [p for p in path.strip().split(".") if p]
+        node = tree
+        for part in parts[:-1]:
+            if part in node and not node[part]:
+                break  # an earlier field already keeps all of this
+            node = node.setdefault(part, {})
+        else:
+            if parts:
+                node[parts[-1]] = {}
+    return tree
+
+
+def project(data, tree):
+    """Keep only the selected keys; lists are projected item by item"""
+    if not tree:
+        return data
+    if isinstance(data, list):
+        return [project(item, tree) for item in data]
+    if isinstance(data, dict):
+        return {key: project(data[key], sub) for key, sub in tree.items() if key in data}
+    return data
+
+# -------------------------
+# Compression
+# -------------------------
+def compress(response, accept_encodings, min_size=1024):
+    """Brotli or gzip a buffered response body in place, if the client accepts it and it's big enough"""
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or "Content-Encoding" in response.headers):
+        return response
+    body = response.get_data()
+    if len(body) < min_size:
+        return response
+    if brotli is not None and accept_encodings["br"]:
+        encoding, body = "br", brotli.compress(body, quality=5)
+    elif accept_encodings["gzip"]:
+        encoding, body = "gzip", gzip.compress(body, compresslevel=6)
+    else:
+        return response
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
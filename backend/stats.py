@@ -0,0 +1,260 @@
+from concurrent.futures import FIRST_COMPLETED, wait
+from functools import partial
+
+# -------------------------
+# Upstream resources
+# Every stat is computed from one of these payloads, so a dashboard load
+# only has to fetch each distinct resource once.
+# -------------------------
+RESOURCES = {
+    "top_artists_short": lambda sp: sp.current_user_top_artists(limit=10, time_range="short_term"),
+    "top_artists_medium": lambda sp: sp.current_user_top_artists(limit=10, time_range="medium_term"),
+    "top_artists_long": lambda sp: sp.current_user_top_artists(limit=10, time_range="long_term"),
+    "top_tracks_short": lambda sp: sp.current_user_top_tracks(limit=10, time_range="short_term"),
+    "top_tracks_medium": lambda sp: sp.current_user_top_tracks(limit=50, time_range="medium_term"),
+    # Spotify returns recently played newest first, so the shorter lists are slices of this one
+    "recently_played": lambda sp: sp.current_user_recently_played(limit=50),
+}
+
+# Not a Spotify payload: the user's stored listening history (see history.py),
+# topped up from the recently_played payload (and the `after` cursor, if there's a gap) before it's read
+PLAY_HISTORY = "play_history"
+
+class UserHistory:
+    """What the history-backed stats see: one user's slice of the HistoryStore"""
+
+    def __init__(self, store, user_id):
+        self.store = store
+        self.user_id = user_id
+
+    def streak(self):
+        return self.store.streak(self.user_id)
+
+    def least_played_tracks(self, limit=10):
+        return self.store.least_played_tracks(self.user_id, limit)
+
+    def top_artist_between(self, start_hour, end_hour):
+        return self.store.top_artist_between(self.user_id, start_hour, end_hour)
+
+# -------------------------
+# Stat calculations (each takes the fetched payloads, keyed by resource name)
+# -------------------------
+def top_artists(payloads):
+    artists = [artist["name"] for artist in payloads["top_artists_short"]["items"]]
+    return {"top_artists_last_4_weeks": artists}
+
+def top_artists_medium(payloads):
+    artists = [artist["name"] for artist in payloads["top_artists_medium"]["items"]]
+    return {"top_artists_last_6_months": artists}
+
+def top_artists_long(payloads):
+    artists = [artist["name"] for artist in payloads["top_artists_long"]["items"]]
+    return {"top_artists_all_time": artists}
+
+def top_tracks(payloads):
+    tracks = [{"name": t["name"], "artist": t["artists"][0]["name"]}
+              for t in payloads["top_tracks_short"]["items"]]
+    return {"top_tracks_last_4_weeks": tracks}
+
+def recently_played(payloads):
+    tracks = [{"name": item["track"]["name"], "artist": item["track"]["artists"][0]["name"]}
+              for item in payloads["recently_played"]["items"][:20]]
+    return {"recently_played": tracks}
+
+def recently_played_last_5(payloads):
+    tracks = [
+        {
+            "name": item["track"]["name"],
+            "artist": item["track"]["artists"][0]["name"],
+            "played_at": item["played_at"]
+        }
+        for item in payloads["recently_played"]["items"][:5]
+    ]
+    return {"recently_played_last_5": tracks}
+
+def hidden_gems(payloads):
+    tracks = [{"name": t["name"], "artist": t["artists"][0]["name"], "popularity": t["popularity"]}
+              for t in payloads["top_tracks_medium"]["items"] if t["popularity"] < 50]
+    return {"hidden_gems": tracks}
+
+def most_skipped(payloads):
+    skipped_tracks = payloads[PLAY_HISTORY].least_played_tracks(10)
+    skipped_list = [{"track": t[0], "approx_plays": t[1]} for t in skipped_tracks]
+    return {"most_skipped": skipped_list}
+
+def top_artist_morning(payloads):
+    return {"top_artist_morning": payloads[PLAY_HISTORY].top_artist_between(5, 11)}
+
+def top_artist_evening(payloads):
+    return {"top_artist_evening": payloads[PLAY_HISTORY].top_artist_between(17, 23)}
+
+def longest_listening_streak(payloads):
+    _, longest = payloads[PLAY_HISTORY].streak()
+    return {"longest_streak_days": longest}
+
+def most_popular_track(payloads):
+    items = payloads["top_tracks_medium"]["items"]
+    if not items:
+        return {"track": "Not available", "artist": "", "popularity": 0}
+    most_popular = max(items, key=lambda t: t["popularity"])
+    return {
+        "track": most_popular["name"],
+        "artist": most_popular["artists"][0]["name"],
+        "popularity": most_popular["popularity"]
+    }
+
+def least_popular_track(payloads):
+    items = payloads["top_tracks_medium"]["items"]
+    if not items:
+        return {"track": "Not available", "artist": "", "popularity": 0}
+    least_popular = min(items, key=lambda t: t["popularity"])
+    return {
+        "track": least_popular["name"],
+        "artist": least_popular["artists"][0]["name"],
+        "popularity": least_popular["popularity"]
+    }
+
+def popularity_distribution(payloads):
+    distribution = {"underground": 0, "moderate": 0, "mainstream": 0}
+    for track in payloads["top_tracks_medium"]["items"]:
+        pop = track["popularity"]
+        if pop < 30:
+            distribution["underground"] += 1
+        elif pop < 60:
+            distribution["moderate"] += 1
+        else:
+            distribution["mainstream"] += 1
+    return {"popularity_distribution": distribution}
+
+def avg_popularity(payloads):
+    items = payloads["top_tracks_medium"]["items"]
+    if not items:
+        return {"avg_popularity": 0}
+    avg = sum(t["popularity"] for t in items) / len(items)
+    return {"avg_popularity": round(avg, 1)}
+
+# stat name -> (resources it reads, calculation)
+STATS = {
+    "top_artists": (["top_artists_short"], top_artists),
+    "top_artists_medium": (["top_artists_medium"], top_artists_medium),
+    "top_artists_long": (["top_artists_long"], top_artists_long),
+    "top_tracks": (["top_tracks_short"], top_tracks),
+    "recently_played": (["recently_played"], recently_played),
+    "recently_played_last_5": (["recently_played"], recently_played_last_5),
+    "hidden_gems": (["top_tracks_medium"], hidden_gems),
+    "most_skipped": ([PLAY_HISTORY], most_skipped),
+    "top_artist_morning": ([PLAY_HISTORY], top_artist_morning),
+    "top_artist_evening": ([PLAY_HISTORY], top_artist_evening),
+    "longest_listening_streak": ([PLAY_HISTORY], longest_listening_streak),
+    "most_popular_track": (["top_tracks_medium"], most_popular_track),
+    "least_popular_track": (["top_tracks_medium"], least_popular_track),
+    "popularity_distribution": (["top_tracks_medium"], popularity_distribution),
+    "avg_popularity": (["top_tracks_medium"], avg_popularity),
+}
+
+# What the frontend dashboard renders when no ?stats= selection is given
+DASHBOARD_STATS = [
+    "top_artists", "top_tracks", "hidden_gems", "popularity_distribution",
+    "longest_listening_streak", "most_popular_track", "least_popular_track",
+    "avg_popularity", "top_artist_morning", "top_artist_evening", "recently_played_last_5",
+]
+
+# -------------------------
+# Planning + computing
+# -------------------------
+def plan_resources(stat_names):
+    """Distinct upstream resources needed for the given stats, in first-use order"""
+    needed = []
+    for name in stat_names:
+        for resource in STATS[name][0]:
+            if resource not in needed:
+                needed.append(resource)
+    return needed
+
+def _resource_fetcher(sp, cache=None, user_id=None, upstream=None, history=None, allow_stale=True):
+    """fetch(name) -> payload, going through whichever of upstream/cache/history we have.
+    With allow_stale=False, stale cached payloads are refetched before they're returned."""
+    def call_upstream(key, fn):
+        return upstream.call(user_id, key, fn) if upstream is not None else fn()
+
+    def fetch(name):
+        if name == PLAY_HISTORY:
+            if history is None or user_id is None:
+                raise ValueError("History-backed stats need a HistoryStore and a user_id (history=, user_id=)")
+            # The (cached, coalesced) recently_played payload already holds the newest
+            # plays, so a sync only goes back to Spotify to fill a gap before them
+            history.sync(user_id, lambda after: call_upstream(
+                f"recently_played_after:{after}",
+                partial(sp.current_user_recently_played, limit=50, after=after)),
+                latest=fetch("recently_played"))
+            return UserHistory(history, user_id)
+        call = partial(call_upstream, name, partial(RESOURCES[name], sp))
+        if cache is not None and user_id is not None:
+            return cache.get_or_fetch(user_id, name, call, allow_stale)
+        return call()
+
+    return fetch
+
+def fetch_resources(sp, resource_names, cache=None, user_id=None, upstream=None, history=None,
+                    allow_stale=True):
+    """Payloads for the given resources. With an upstream client they are fetched
+    concurrently, rate limited and coalesced; with a cache, fresh copies skip Spotify."""
+    fetch = _resource_fetcher(sp, cache, user_id, upstream, history, allow_stale)
+    if upstream is None or len(resource_names) < 2:
+        return {name: fetch(name) for name in resource_names}
+    futures = {name: upstream.submit(fetch, name) for name in resource_names}
+    return {name: future.result() for name, future in futures.items()}
+
+def compute_stats(sp, stat_names, cache=None, user_id=None, upstream=None, history=None, allow_stale=True):
+    """Fetch each needed resource once, then compute every requested stat from the shared payloads"""
+    payloads = fetch_resources(sp, plan_resources(stat_names), cache, user_id, upstream, history, allow_stale)
+    return {name: STATS[name][1](payloads) for name in stat_names}
+
+def iter_stats(sp, stat_names, cache=None, user_id=None, upstream=None, history=None, heartbeat=15):
+    """Like compute_stats, but yields each stat as soon as the resources it reads have arrived.
+
+    Yields ("stat", name, result), ("error", name, exception) for stats whose
+    resource (or calculation) failed, and ("heartbeat", None, None) whenever
+    `heartbeat` seconds pass with nothing else to report."""
+    fetch = _resource_fetcher(sp, cache, user_id, upstream, history)
+    waiting = list(stat_names)
+    payloads = {}
+    failed = {}
+
+    def ready():
+        for name in list(waiting):
+            resources = STATS[name][0]
+            error = next((failed[r] for r in resources if r in failed), None)
+            if error is None and not all(r in payloads for r in resources):
+                continue
+            waiting.remove(name)
+            if error is not None:
+                yield "error", name, error
+                continue
+            try:
+                yield "stat", name, STATS[name][1](payloads)
+            except Exception as e:
+                yield "error", name, e
+
+    if upstream is None:
+        for resource in plan_resources(stat_names):
+            try:
+                payloads[resource] = fetch(resource)
+            except Exception as e:
+                failed[resource] = e
+            yield from ready()
+        return
+
+    pending = {upstream.submit(fetch, resource): resource for resource in plan_resources(stat_names)}
+    while pending:
+        done, _ = wait(pending, timeout=heartbeat, return_when=FIRST_COMPLETED)
+        if not done:
+            yield "heartbeat", None, None
+            continue
+        for future in done:
+            resource = pending.pop(future)
+            try:
+                payloads[resource] = future.result()
+            except Exception as e:
+                failed[resource] = e
+        yield from ready()
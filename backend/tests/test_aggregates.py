@@ -0,0 +1,105 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import aggregates
+from history import HistoryStore
+
+START = datetime(2024, 3, 1, 4, 0, tzinfo=timezone.utc)
+
+
+def _item(played_at, track, artist):
+    return {"played_at": played_at.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+            "track": {"id": track, "name": track, "artists": [{"id": artist, "name": artist}]}}
+
+
+def _plays(n=400, seed=7):
+    """Plays spread over ~3 weeks with gaps, so streaks break and restart"""
+    rng = random.Random(seed)
+    played_at = START
+    items = []
+    for _ in range(n):
+        played_at += timedelta(minutes=rng.choice([3, 4, 30, 240, 600, 2000]))
+        items.append(_item(played_at, f"track{rng.randint(0, 40)}", f"artist{rng.randint(0, 8)}"))
+    return items
+
+
+def _snapshot(store, user_id):
+    return aggregates._snapshot(store._connect(), user_id)
+
+
+def test_incremental_matches_rebuild_with_out_of_order_batches(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"))
+    items = _plays()
+    batches = [items[i:i + 50] for i in range(0, len(items), 50)]
+    random.Random(3).shuffle(batches)
+    for batch in batches:
+        store.ingest_items("u1", batch)
+    # re-ingesting overlapping pages must not count anything twice
+    store.ingest_items("u1", items[100:180])
+
+    incremental = _snapshot(store, "u1")
+    assert aggregates.check(store._connect()) == []
+    aggregates.rebuild(store._connect())
+    assert _snapshot(store, "u1") == incremental
+
+
+def test_incremental_matches_rebuild_in_order(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"))
+    items = _plays(seed=11)
+    for i in range(0, len(items), 50):
+        store.ingest_items("u1", items[i:i + 50])
+    incremental = _snapshot(store, "u1")
+    aggregates.rebuild(store._connect())
+    assert _snapshot(store, "u1") == incremental
+
+
+def test_streak_recounted_when_an_older_play_fills_a_gap(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"))
+    days = [START + timedelta(days=d) for d in (0, 1, 3, 4, 5)]
+    store.ingest_items("u1", [_item(d, "a", "x") for d in days])
+    assert store._connect().execute("SELECT current, longest FROM streaks").fetchone() == (3, 3)
+    # day 2 arrives late and joins both runs into one
+    store.ingest_items("u1", [_item(START + timedelta(days=2), "b", "x")])
+    assert store._connect().execute("SELECT current, longest FROM streaks").fetchone() == (6, 6)
+    assert aggregates.check(store._connect()) == []
+
+
+def test_check_reports_drift_and_leaves_the_tables_alone(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"))
+    store.ingest_items("u1", _plays(n=60))
+    store.ingest_items("u2", _plays(n=60, seed=9))
+    conn = store._connect()
+    with conn:
+        conn.execute("UPDATE track_counts SET plays = plays + 1 WHERE user_id = 'u2'")
+    drifted = _snapshot(store, "u2")
+    assert aggregates.check(conn, "u2") == ["u2"]
+    assert _snapshot(store, "u2") == drifted
+
+
+def test_check_recounts_streaks_independently_of_apply(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"))
+    store.ingest_items("u1", _plays(n=120))
+    store.ingest_items("u2", _plays(n=120, seed=5))
+    conn = store._connect()
+    assert {user: counts["longest"] for user, counts in aggregates.recount(conn).items()} == dict(
+        conn.execute("SELECT user_id, longest FROM streaks"))
+    # the stored streak is held against the columnar recount, not only a replay of apply()
+    with conn:
+        conn.execute("UPDATE streaks SET longest = longest + 1 WHERE user_id = 'u1'")
+    assert aggregates.check(conn) == ["u1"]
+    assert aggregates.check(conn, "u2") == []
+
+
+def test_recount_catches_a_bug_that_replaying_apply_would_repeat(tmp_path, monkeypatch):
+    store = HistoryStore(str(tmp_path / "history.db"))
+    conn = store._connect()
+    store.ingest_items("u1", _plays(n=80))
+    recounted = aggregates.recount(conn)["u1"]
+    assert recounted["hour_artist_counts"] == _snapshot(store, "u1")["hour_artist_counts"]
+    assert recounted["track_counts"] == _snapshot(store, "u1")["track_counts"]
+
+    # apply() bucketing plays an hour off: a replay inside check() makes the same mistake
+    real_utc = aggregates._utc
+    monkeypatch.setattr(aggregates, "_utc", lambda played_at: real_utc(played_at) + timedelta(hours=1))
+    store.ingest_items("u2", _plays(n=80, seed=4))
+    assert aggregates.check(conn, "u2") == ["u2"]
@@ -0,0 +1,246 @@
+import json
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from spotipy.exceptions import SpotifyException
+
+import upstream
+from upstream import RateLimited, TokenBucket, UpstreamClient
+
+
+class FakeClock:
+    """Stands in for time.monotonic/time.sleep inside upstream.py; sleeping advances the clock"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(upstream.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(upstream.time, "sleep", clock.sleep)
+    return clock
+
+# -------------------------
+# TokenBucket
+# -------------------------
+def test_burst_up_to_capacity_then_waits_for_refill(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    for _ in range(3):
+        bucket.acquire(max_wait=10)
+    assert clock.slept == []
+    bucket.acquire(max_wait=10)
+    assert clock.slept == [pytest.approx(0.5)]
+
+
+def test_waiters_reserve_tokens_in_turn(clock, monkeypatch):
+    bucket = TokenBucket(rate=1, capacity=1)
+    bucket.acquire(max_wait=10)
+    # Concurrent callers: the clock doesn't move while they sleep, each reserves the next token
+    monkeypatch.setattr(upstream.time, "sleep", clock.slept.append)
+    bucket.acquire(max_wait=10)
+    bucket.acquire(max_wait=10)
+    assert clock.slept == [pytest.approx(1), pytest.approx(2)]
+
+
+def test_refill_is_capped_at_capacity(clock):
+    bucket = TokenBucket(rate=1, capacity=2)
+    clock.now += 100
+    for _ in range(2):
+        bucket.acquire(max_wait=10)
+    bucket.acquire(max_wait=10)
+    assert clock.slept == [pytest.approx(1)]
+
+
+def test_refuses_instead_of_waiting_past_max_wait(clock):
+    bucket = TokenBucket(rate=1, capacity=1)
+    bucket.acquire(max_wait=10)
+    with pytest.raises(RateLimited) as e:
+        bucket.acquire(max_wait=0.5)
+    assert e.value.retry_after == pytest.approx(1)
+    # A refusal doesn't take a token, so the next caller's wait is unchanged
+    bucket.acquire(max_wait=10)
+    assert clock.slept == [pytest.approx(1)]
+
+
+def test_block_holds_everything_until_retry_after_and_drops_the_burst(clock):
+    bucket = TokenBucket(rate=1, capacity=5)
+    bucket.block(3)
+    bucket.acquire(max_wait=10)
+    # 3s blocked, then refill starts from empty
+    assert clock.slept == [pytest.approx(4)]
+
+
+def test_shorter_block_does_not_shorten_a_longer_one(clock):
+    bucket = TokenBucket(rate=10, capacity=5)
+    bucket.block(5)
+    bucket.block(1)
+    with pytest.raises(RateLimited) as e:
+        bucket.acquire(max_wait=2)
+    assert e.value.retry_after == pytest.approx(5.1)
+
+# -------------------------
+# UpstreamClient.call coalescing
+# -------------------------
+def _in_threads(n, target):
+    results = [None] * n
+    errors = [None] * n
+
+    def run(i):
+        try:
+            results[i] = target(i)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+@pytest.fixture
+def waiters(monkeypatch):
+    """Counts threads blocked on a coalesced call's shared future, so a test can hold the
+    owner's upstream call until every other caller is known to be waiting on it"""
+    class Waiters:
+        def __init__(self):
+            self.count = 0
+            self.changed = threading.Condition()
+
+        def wait_for(self, n):
+            with self.changed:
+                assert self.changed.wait_for(lambda: self.count >= n, timeout=5), f"only {self.count} waiters"
+
+    waiters = Waiters()
+
+    class CountingFuture(Future):
+        def result(self, timeout=None):
+            with waiters.changed:
+                waiters.count += 1
+                waiters.changed.notify_all()
+            return super().result(timeout)
+
+    monkeypatch.setattr(upstream, "Future", CountingFuture)
+    return waiters
+
+
+def _upstream_call(calls, until=lambda: None, result=None, error=None):
+    def fn():
+        calls.append(threading.current_thread().name)
+        until()
+        if error is not None:
+            raise error
+        return result
+    return fn
+
+
+def test_identical_in_flight_calls_share_one_upstream_request(waiters):
+    client = UpstreamClient(pool_size=2)
+    calls = []
+    fn = _upstream_call(calls, until=lambda: waiters.wait_for(3), result={"items": []})
+    threads, results, errors = _in_threads(4, lambda i: client.call("user", "recently_played", fn))
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert errors == [None] * 4
+    assert all(result is results[0] for result in results)
+    assert client._in_flight == {}
+
+
+def test_different_users_or_keys_are_not_coalesced():
+    client = UpstreamClient(pool_size=2)
+    calls = []
+    fn = _upstream_call(calls, result=1)
+    client.call("a", "recently_played", fn)
+    client.call("b", "recently_played", fn)
+    client.call("a", "top_artists_short", fn)
+    assert len(calls) == 3
+
+
+def test_a_failed_call_reaches_every_waiter_and_is_not_cached(waiters):
+    client = UpstreamClient(pool_size=2)
+    calls = []
+    fn = _upstream_call(calls, until=lambda: waiters.wait_for(2), error=ValueError("boom"))
+    threads, _, errors = _in_threads(3, lambda i: client.call("user", "me", fn))
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert all(isinstance(e, ValueError) for e in errors)
+    # The next call goes upstream again
+    assert client.call("user", "me", lambda: "ok") == "ok"
+
+# -------------------------
+# Transient upstream failures
+# -------------------------
+@pytest.fixture
+def spotify_api():
+    """A local API answering each request with the next scripted status (200 once they run out)"""
+    statuses, seen = [], []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            seen.append(self.path)
+            status = statuses.pop(0) if statuses else 200
+            body = json.dumps({"id": "user"} if status == 200 else {"error": {"status": status}}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if status == 429:
+                self.send_header("Retry-After", "1")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/v1/", statuses, seen
+    server.shutdown()
+
+
+def _client(api_prefix):
+    client = UpstreamClient(pool_size=2, api_prefix=api_prefix)
+    client.session.get_adapter(api_prefix).max_retries.backoff_max = 0  # keep the backoff out of test time
+    return client
+
+
+def test_transient_5xx_are_retried_by_the_session(spotify_api):
+    api_prefix, statuses, seen = spotify_api
+    statuses.extend([503, 502, 500])
+    client = _client(api_prefix)
+    assert client.call("user", "me", client.spotify("token").current_user) == {"id": "user"}
+    assert len(seen) == 4
+
+
+def test_persistent_5xx_surfaces_as_itself_not_as_a_rate_limit(spotify_api):
+    api_prefix, statuses, seen = spotify_api
+    statuses.extend([500] * 5)
+    client = _client(api_prefix)
+    with pytest.raises(SpotifyException) as e:
+        client.call("user", "me", client.spotify("token").current_user)
+    assert e.value.http_status == 500
+    assert len(seen) == 4
+
+
+def test_429_is_left_to_call_and_its_retry_after(spotify_api, clock):
+    api_prefix, statuses, seen = spotify_api
+    statuses.extend([429, 429])
+    client = _client(api_prefix)
+    client.max_retries = 1
+    with pytest.raises(RateLimited):
+        client.call("user", "me", client.spotify("token").current_user)
+    # one request per call() attempt, none from the session, and the limiter waited out Retry-After
+    assert len(seen) == 2
+    assert clock.slept == [pytest.approx(1 + 1 / client.global_bucket.rate)]
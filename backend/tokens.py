@@ -0,0 +1,58 @@
+import json
+import logging
+import time
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:  # only needed to share tokens between workers
+    Fernet = None
+
+from cache import MemoryBackend
+
+log = logging.getLogger(__name__)
+
+
+class TokenStore:
+    """Spotify tokens (access + refresh) of recently logged in users, one record
+    per user id, so background jobs can keep their dashboards warm.
+
+    With a key (a Fernet key, e.g. TOKEN_ENCRYPTION_KEY) records are encrypted
+    and kept in the shared cache backend, so any worker can use them. Without
+    one they never leave this process."""
+
+    def __init__(self, backend, key=None):
+        if key:
+            if Fernet is None:
+                raise RuntimeError("cryptography is not installed, pip install cryptography "
+                                   "or unset TOKEN_ENCRYPTION_KEY")
+            self.fernet = Fernet(key)
+            self.backend = backend
+        else:
+            self.fernet = None
+            self.backend = MemoryBackend()
+
+    @property
+    def shared(self):
+        return self.fernet is not None
+
+    def save(self, user_id, token_info, until):
+        """Keep token_info until the `until` timestamp (re-saving a refreshed token
+        with the old `until` doesn't extend it)"""
+        if self.fernet is not None:
+            token_info = self.fernet.encrypt(json.dumps(token_info).encode()).decode()
+        self.backend.set(f"tokens:{user_id}", {"token": token_info, "until": until},
+                         max(1, until - time.time()))
+
+    def load(self, user_id):
+        """(token_info, until), or None if there's nothing usable for this user"""
+        record = self.backend.get(f"tokens:{user_id}")
+        if record is None or record["until"] <= time.time():
+            return None
+        token_info = record["token"]
+        if self.fernet is not None:
+            try:
+                token_info = json.loads(self.fernet.decrypt(token_info.encode()))
+            except InvalidToken:
+                log.warning("stored token for %s doesn't decrypt (key rotated?), skipping", user_id)
+                return None
+        return token_info, record["until"]
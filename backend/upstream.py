@@ -0,0 +1,182 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+import spotipy
+from urllib3.util.retry import Retry
+from spotipy.exceptions import SpotifyException
+
+import metrics
+
+
+class RateLimited(Exception):
+    """Spotify (or our own limiter) says back off for retry_after seconds"""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"Rate limited, retry after {retry_after:.0f}s")
+
+
+def _retry_after(error, default=1.0):
+    try:
+        return float(error.headers.get("Retry-After", default))
+    except (TypeError, ValueError):
+        return default
+
+# -------------------------
+# Token bucket
+# -------------------------
+class TokenBucket:
+    """rate tokens/second up to capacity. Callers reserve a token and sleep
+    outside the lock, so waiters queue up fairly instead of spinning."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+            self.updated = max(now, self.updated)
+            wait = max(0.0, self.blocked_until - now)
+            if self.tokens < 1:
+                # refill only starts at self.updated, which is in the future while blocked
+                wait = max(wait, max(0.0, self.updated - now) + (1 - self.tokens) / self.rate)
+            if wait > max_wait:
+                metrics.RATE_LIMIT_HITS.labels("local").inc()
+                raise RateLimited(wait)
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+
+    def block(self, seconds):
+        """Honor a Retry-After: nothing goes out until it passes, and no burst builds up meanwhile"""
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self.blocked_until:
+                self.blocked_until = until
+                self.tokens = min(self.tokens, 0)
+                self.updated = until
+
+# -------------------------
+# Shared upstream client
+# -------------------------
+class InstrumentedSession(requests.Session):
+    """Every spotipy call goes through request(), so this is where upstream timing is recorded"""
+
+    def __init__(self, api_prefix):
+        super().__init__()
+        self.api_prefix = api_prefix
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = metrics.upstream_endpoint(url, self.api_prefix)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            metrics.observe_upstream(endpoint, status, time.perf_counter() - start)
+
+
+class UpstreamClient:
+    """One keep-alive session and one thread pool for every Spotify call the app makes.
+
+    call() rate limits per user and globally, retries 429s after their
+    Retry-After, and coalesces identical in-flight calls (same user + key)
+    into a single upstream request."""
+
+    def __init__(self, pool_size=16, global_rate=20.0, global_burst=40,
+                 user_rate=5.0, user_burst=10, max_wait=10.0, max_retries=2, max_users=10000,
+                 api_prefix=None):
+        self.session = InstrumentedSession(api_prefix or "https://api.spotify.com/v1/")
+        # Our own session turns off spotipy's retries, so bring back the transient ones:
+        # dropped connections and 5xx, with backoff. 429s stay out, call() handles their
+        # Retry-After; after the last retry the 5xx itself is raised, not a "Max Retries" 429.
+        retry = Retry(total=3, status_forcelist=(500, 502, 503, 504), backoff_factor=0.3,
+                      allowed_methods={"GET"}, raise_on_status=False, respect_retry_after_header=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="spotify")
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.max_users = max_users
+        self.api_prefix = api_prefix
+        self._user_buckets = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def spotify(self, access_token):
+        # Passing our own session also turns off spotipy's built-in retries,
+        # so 429s reach call() with their Retry-After header intact
+        sp = spotipy.Spotify(auth=access_token, requests_session=self.session)
+        if self.api_prefix:
+            sp.prefix = self.api_prefix  # e.g. the local stand-in in bench/mock_spotify.py
+        return sp
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def call(self, user_key, key, fn):
+        if user_key is None:
+            return self._call_with_limits(None, fn)
+        flight_key = (user_key, key)
+        with self._lock:
+            future = self._in_flight.get(flight_key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[flight_key] = future
+        if not owner:
+            return future.result()
+        try:
+            result = self._call_with_limits(user_key, fn)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(flight_key, None)
+
+    def _user_bucket(self, user_key):
+        with self._lock:
+            bucket = self._user_buckets.get(user_key)
+            if bucket is None:
+                bucket = self._user_buckets[user_key] = TokenBucket(self.user_rate, self.user_burst)
+                while len(self._user_buckets) > self.max_users:
+                    self._user_buckets.popitem(last=False)
+            else:
+                self._user_buckets.move_to_end(user_key)
+            return bucket
+
+    def _call_with_limits(self, user_key, fn):
+        user_bucket = self._user_bucket(user_key) if user_key is not None else None
+        for attempt in range(self.max_retries + 1):
+            if user_bucket is not None:
+                user_bucket.acquire(self.max_wait)
+            self.global_bucket.acquire(self.max_wait)
+            try:
+                return fn()
+            except SpotifyException as e:
+                if e.http_status != 429:
+                    raise
+                retry_after = _retry_after(e)
+                metrics.RATE_LIMIT_HITS.labels("spotify").inc()
+                # Spotify rate limits the whole app, so everyone backs off
+                self.global_bucket.block(retry_after)
+                if attempt == self.max_retries or retry_after > self.max_wait:
+                    raise RateLimited(retry_after)
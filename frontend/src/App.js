@@ -32,7 +32,7 @@ function App() {
     window.location.href = "http://127.0.0.1:8000/login";
   };
 
-  const loadStats = async () => {
+  const loadStats = () => {
     if (!token) {
       alert("Please login with Spotify first!");
       return;
@@ -40,47 +40,42 @@ function App() {
 
     setLoading(true);
     setError(null);
-    try {
-      const fetchJSON = async (url) => {
-        const res = await fetch(url, {
-          headers: { Authorization: `Bearer ${token}` },
-        });
-        if (!res.ok) {
-          throw new Error(`${url} failed`);
-        }
-        return res.json();
-      };
 
-      const [a1, a2, a3, a4, a5, a6, a7, a8, a9, a10, a11] = await Promise.all([
-        fetchJSON("http://127.0.0.1:8000/top-artists"),
-        fetchJSON("http://127.0.0.1:8000/top-tracks"),
-        fetchJSON("http://127.0.0.1:8000/hidden-gems"),
-        fetchJSON("http://127.0.0.1:8000/popularity-distribution"),
-        fetchJSON("http://127.0.0.1:8000/longest-listening-streak"),
-        fetchJSON("http://127.0.0.1:8000/most-popular-track"),
-        fetchJSON("http://127.0.0.1:8000/least-popular-track"),
-        fetchJSON("http://127.0.0.1:8000/avg-popularity"),
-        fetchJSON("http://127.0.0.1:8000/top-artist-morning"),
-        fetchJSON("http://127.0.0.1:8000/top-artist-evening"),
-        fetchJSON("http://127.0.0.1:8000/recently-played-last-5"),
-      ]);
+    // Each stat arrives as its own event as soon as the backend has it
+    const statHandlers = {
+      top_artists: (d) => setTopArtists(d.top_artists_last_4_weeks || []),
+      top_tracks: (d) => setTopTracks(d.top_tracks_last_4_weeks || []),
+      hidden_gems: (d) => setHiddenGems(d.hidden_gems || []),
+      popularity_distribution: (d) => setPopularityDistribution(d.popularity_distribution || null),
+      longest_listening_streak: (d) => setLongestStreak(d.longest_streak_days),
+      most_popular_track: (d) => setMostPopularTrack(d || null),
+      least_popular_track: (d) => setLeastPopularTrack(d || null),
+      avg_popularity: (d) => setAvgPopularity(d.avg_popularity || null),
+      top_artist_morning: (d) => setTopArtistMorning(d.top_artist_morning || null),
+      top_artist_evening: (d) => setTopArtistEvening(d.top_artist_evening || null),
+      recently_played_last_5: (d) => setRecentlyPlayed(d.recently_played_last_5 || []),
+    };
 
-      setTopArtists(a1.top_artists_last_4_weeks || []);
-      setTopTracks(a2.top_tracks_last_4_weeks || []);
-      setHiddenGems(a3.hidden_gems || []);
-      setPopularityDistribution(a4.popularity_distribution || null);
-      setLongestStreak(a5.longest_streak_days);
-      setMostPopularTrack(a6 || null);
-      setLeastPopularTrack(a7 || null);
-      setAvgPopularity(a8.avg_popularity || null);
-      setTopArtistMorning(a9.top_artist_morning || null);
-      setTopArtistEvening(a10.top_artist_evening || null);
-      setRecentlyPlayed(a11.recently_played_last_5 || []);
+    const source = new EventSource(
+      `http://127.0.0.1:8000/dashboard/stream?token=${encodeURIComponent(token)}`
+    );
+    source.addEventListener("stat", (e) => {
+      const { stat, data } = JSON.parse(e.data);
+      if (statHandlers[stat]) statHandlers[stat](data);
       setStatsLoaded(true);
-    } catch (err) {
-      setError(err.message);
-    }
-    setLoading(false);
+      setLoading(false);
+    });
+    source.addEventListener("done", () => {
+      source.close();
+      setLoading(false);
+    });
+    source.addEventListener("error", (e) => {
+      source.close();
+      // Our own "error" event carries data, a dropped connection doesn't
+      const message = e.data ? JSON.parse(e.data).error : "Lost connection to the stats stream";
+      setError(message);
+      setLoading(false);
+    });
   };
 
   const pieColors = ["#667eea", "#f857a6", "#4facfe", "#43e97b", "#feca57"];